@@ -1,32 +1,101 @@
+import datetime
+import threading
+from types import MappingProxyType
+from typing import Callable, List, Optional
+
 import telebot
-from telebot import apihelper
+from telebot import apihelper, util
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, MessageEntity, Message, CallbackQuery
 
-from beancount_bot import transaction
 from beancount_bot.config import get_config, load_config
 from beancount_bot.dispatcher import Dispatcher
 from beancount_bot.i18n import _
 from beancount_bot.session import get_session, SESS_AUTH, get_session_for, set_session, SESS_TX_TAGS
 from beancount_bot.session_config import SESSION_CONFIG
-from beancount_bot.task import load_task, get_task
-from beancount_bot.transaction import get_manager
+from beancount_bot.task import load_task, get_task, get_task_executor, TaskJob, JOB_PENDING, JOB_RUNNING, \
+    JOB_SUCCEEDED, JOB_FAILED, SOURCE_MANUAL
+from beancount_bot.transaction import get_manager, split_blocks
 from beancount_bot.util import logger
+from beancount_bot.worker_pool import OrderedWorkerPool
 
 apihelper.ENABLE_MIDDLEWARE = True
 
-bot = telebot.TeleBot(token=None, parse_mode=None)
+# 批量添加的最大交易数。Telegram 单条消息最多附带 100 个按键，每条交易占用一个撤回按键
+MAX_BATCH_SIZE = 100
 
 
-@bot.middleware_handler(update_types=['message'])
-def session_middleware(bot_instance, message):
+class SessionBot(telebot.TeleBot):
     """
-    会话中间件
-    :param bot_instance:
-    :param message:
-    :return:
+    会话上下文（session_user_id、session）按线程保存，处理器可在多个线程中同时处理不同用户的更新
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._context = threading.local()
+        # 按用户分片的线程池。设置后处理器在其中执行，同一用户的更新按顺序处理
+        self.ordered_pool: Optional[OrderedWorkerPool] = None
+
+    @property
+    def session_user_id(self) -> Optional[int]:
+        return getattr(self._context, 'user_id', None)
+
+    @session_user_id.setter
+    def session_user_id(self, uid: int):
+        self._context.user_id = uid
+
+    @property
+    def session(self) -> Optional[MappingProxyType]:
+        return getattr(self._context, 'session', None)
+
+    @session.setter
+    def session(self, session: MappingProxyType):
+        self._context.session = session
+
+    def bind_session(self, update):
+        """
+        将当前线程的会话上下文设为更新的发送者。更新没有发送者时清空，以免沿用上一更新的会话
+        :param update: 带有 from_user 的更新，如 Message、CallbackQuery
+        :return:
+        """
+        uid = update_user_id(update)
+        if uid is not None:
+            self.session_user_id = uid
+            self.session = get_session_for(uid)
+        else:
+            self.session_user_id = None
+            self.session = None
+
+    def run_handler(self, handler: Callable, update, *args, **kwargs):
+        """
+        绑定会话上下文后执行处理器
+        :param handler:
+        :param update:
+        :return:
+        """
+        self.bind_session(update)
+        return handler(update, *args, **kwargs)
+
+    def _exec_task(self, task, *args, **kwargs):
+        if len(args) == 0:
+            super()._exec_task(task, *args, **kwargs)
+        elif self.ordered_pool is not None:
+            self.ordered_pool.submit(update_user_id(args[0]), self.run_handler, task, *args, **kwargs)
+        else:
+            # 在实际执行处理器的线程中绑定会话上下文
+            super()._exec_task(self.run_handler, task, *args, **kwargs)
+
+
+def update_user_id(update) -> Optional[int]:
+    """
+    获得更新的发送者
+    :param update:
+    :return: 没有发送者时返回 None
     """
-    bot_instance.session_user_id = message.from_user.id
-    bot_instance.session = get_session_for(message.from_user.id)
+    from_user = getattr(update, 'from_user', None)
+    return from_user.id if from_user is not None else None
+
+
+bot = SessionBot(token=None, parse_mode=None)
 
 
 #######
@@ -114,6 +183,7 @@ def help_handler(message):
             _("/help - 使用帮助"),
             _("/reload - 重新加载配置文件"),
             _("/task - 查看、运行任务"),
+            _("/jobs - 查看任务运行状态"),
             _("/set - 设置用户特定配置"),
             _("/get - 获取用户特定配置"),
         ]
@@ -186,11 +256,66 @@ def task_handler(message):
             bot.reply_to(message, _("任务不存在！"))
             return
         task = tasks[dest]
-        try:
-            task.trigger(bot)
-        except Exception as e:
-            logger.error(f'{message.from_user.id}：发生未知错误！执行任务失败。', exc_info=e)
-            bot.reply_to(message, _("发生未知错误！执行任务失败。"))
+
+        def on_done(job: TaskJob):
+            if job.status == JOB_FAILED:
+                bot.reply_to(message, _("任务 {name}（#{id}）执行失败：{error}").format(
+                    name=job.name, id=job.id, error=job.error))
+            else:
+                bot.reply_to(message, _("任务 {name}（#{id}）执行完成，用时 {seconds:.1f}s").format(
+                    name=job.name, id=job.id, seconds=job.elapsed))
+
+        job, created = get_task_executor().submit(dest, task, bot, callback=on_done)
+        if created:
+            bot.reply_to(message, _("任务 {name} 已开始执行，编号 #{id}。可通过 /jobs 查看进度").format(
+                name=job.name, id=job.id))
+        else:
+            bot.reply_to(message, _("任务 {name} 正在执行（#{id}），未重复触发").format(name=job.name, id=job.id))
+
+
+def format_job(job: TaskJob) -> str:
+    """
+    任务运行记录的一行描述
+    :param job:
+    :return:
+    """
+    source = _("手动") if job.source == SOURCE_MANUAL else _("定时")
+    if job.status == JOB_PENDING:
+        return _("#{id} {name}：等待执行（{source}）").format(id=job.id, name=job.name, source=source)
+    if job.status == JOB_RUNNING:
+        return _("#{id} {name}：已运行 {seconds:.1f}s（{source}）").format(
+            id=job.id, name=job.name, seconds=job.elapsed, source=source)
+    status = _("成功") if job.status == JOB_SUCCEEDED else _("失败")
+    finished = datetime.datetime.fromtimestamp(job.finished).strftime('%m-%d %H:%M:%S')
+    return _("#{id} {name}：{status}，用时 {seconds:.1f}s（{source}，{finished}）").format(
+        id=job.id, name=job.name, status=status, seconds=job.elapsed, source=source, finished=finished)
+
+
+@bot.message_handler(commands=['jobs'])
+def jobs_handler(message):
+    """
+    任务运行状态指令
+    :param message:
+    :return:
+    """
+    if not check_auth():
+        bot.reply_to(message, _("请先进行鉴权！"))
+        return
+
+    running, finished = get_task_executor().jobs()
+    if len(running) == 0 and len(finished) == 0:
+        bot.reply_to(message, _("暂无任务运行记录"))
+        return
+    lines = []
+    if len(running) > 0:
+        lines.append(_("正在执行："))
+        lines.extend(format_job(job) for job in running)
+    if len(finished) > 0:
+        if len(lines) > 0:
+            lines.append('')
+        lines.append(_("最近完成："))
+        lines.extend(format_job(job) for job in finished)
+    bot.reply_to(message, '\n'.join(lines))
 
 
 ##################
@@ -253,13 +378,19 @@ def transaction_query_handler(message: Message):
     try:
         # 准备交易上下文
         tags = get_config('transaction.tags', []) + get_session(message.from_user.id, SESS_TX_TAGS, [])
+        # 多条语句使用批量模式
+        blocks = split_blocks(message.text)
+        if len(blocks) > 1:
+            transaction_batch_handler(message, blocks, tags)
+            return
         # 处理交易
-        tx_uuid, tx = manager.create_from_str(message.text, add_tags=tags)
+        result = manager.create_from_str(message.text, add_tags=tags)
+        tx_uuid = result[0]
         # 创建消息按键
         markup = InlineKeyboardMarkup()
         markup.add(InlineKeyboardButton(_("撤回交易"), callback_data=f'withdraw:{tx_uuid}'))
-        # 回复
-        bot.reply_to(message, transaction.stringfy(tx), reply_markup=markup)
+        # 回复。直接使用写入账本的文本
+        bot.reply_to(message, result.reply_text, reply_markup=markup)
     except ValueError as e:
         logger.info(f'{message.from_user.id}：无法添加交易', exc_info=e)
         bot.reply_to(message, e.args[0])
@@ -271,6 +402,45 @@ def transaction_query_handler(message: Message):
         bot.reply_to(message, _("发生未知错误！添加交易失败。"))
 
 
+def transaction_batch_handler(message: Message, blocks: List[str], tags: List[str]):
+    """
+    批量交易处理。所有语句校验通过后一次写入，每条交易有各自的撤回按键
+    :param message:
+    :param blocks: 切分后的语句
+    :param tags: 给交易添加的标签
+    :return:
+    """
+    # 写入前检查，避免交易已写入而回复无法发送
+    if len(blocks) > MAX_BATCH_SIZE:
+        bot.reply_to(message, _("一次最多添加 {max} 条交易，当前为 {n} 条").format(max=MAX_BATCH_SIZE, n=len(blocks)))
+        return
+    results = get_manager().create_batch(blocks, add_tags=tags)
+    # 创建消息按键
+    markup = InlineKeyboardMarkup()
+    markup.add(*[InlineKeyboardButton(_("撤回第 {n} 条").format(n=i), callback_data=f'withdraw:{result[0]}')
+                 for i, result in enumerate(results, 1)])
+    bot.reply_to(message, batch_reply([result.reply_text for result in results]), reply_markup=markup)
+
+
+def batch_reply(texts: List[str]) -> str:
+    """
+    生成批量交易的回复。超出消息长度限制时只回复每条交易的首行，仍超出则截断各行，保证不超出限制
+    :param texts: 各条交易的文本
+    :return:
+    """
+    texts = [text.rstrip() for text in texts]
+    reply = '\n'.join(f'{i}. {text}' for i, text in enumerate(texts, 1))
+    if len(reply) <= util.MAX_MESSAGE_LENGTH:
+        return reply
+    lines = [f'{i}. ' + text.split('\n', 1)[0] for i, text in enumerate(texts, 1)]
+    reply = '\n'.join(lines)
+    if len(reply) <= util.MAX_MESSAGE_LENGTH:
+        return reply
+    # 每行（含换行符）平分长度限制
+    width = util.MAX_MESSAGE_LENGTH // len(lines) - 1
+    return '\n'.join(line if len(line) <= width else line[:width - 1] + '…' for line in lines)
+
+
 @bot.callback_query_handler(func=lambda call: call.data[:8] == 'withdraw')
 def callback_withdraw(call: CallbackQuery):
     """
@@ -286,6 +456,18 @@ def callback_withdraw(call: CallbackQuery):
     manager = get_manager()
     try:
         manager.remove(tx_uuid)
+        # 批量交易只移除对应的撤回按键
+        markup = call.message.reply_markup
+        buttons = [button for row in markup.keyboard for button in row
+                   if button.callback_data != call.data] if markup is not None else []
+        if len(buttons) > 0:
+            remaining = InlineKeyboardMarkup()
+            remaining.add(*buttons)
+            bot.edit_message_reply_markup(chat_id=call.message.chat.id,
+                                          message_id=call.message.message_id,
+                                          reply_markup=remaining)
+            bot.answer_callback_query(call.id, _("交易已撤回"))
+            return
         # 修改原消息回复
         message = _("交易已撤回")
         code_format = MessageEntity('code', 0, len(message))
@@ -304,12 +486,11 @@ def callback_withdraw(call: CallbackQuery):
         bot.answer_callback_query(call.id, _("发生未知错误！撤回交易失败。"))
 
 
-def serving():
+def setup_bot():
     """
-    启动 Bot
+    从配置设置 Token、代理
     :return:
     """
-
     # 设置 Token
     token = get_config('bot.token')
     bot.token = token
@@ -317,5 +498,16 @@ def serving():
     proxy = get_config('bot.proxy')
     if proxy is not None:
         apihelper.proxy = {'https': proxy}
+    # 处理器线程池
+    if bot.ordered_pool is None:
+        bot.ordered_pool = OrderedWorkerPool(get_config('serving.workers', 8), name='handler')
+
+
+def serving():
+    """
+    启动 Bot
+    :return:
+    """
+    setup_bot()
     # 启动
     bot.infinity_polling()
@@ -0,0 +1,178 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+
+from beancount_bot import metrics
+from beancount_bot.config import get_config
+from beancount_bot.util import logger
+
+_broadcaster: Optional['Broadcaster'] = None
+_broadcaster_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    令牌桶限流器。线程安全
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: 每秒产生的令牌数
+        :param capacity: 桶容量，即允许的突发数量。默认与 rate 相同
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        取得一个令牌，没有令牌时阻塞
+        :return:
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        暂停发放令牌，并清空桶。用于服务端要求等待时
+        :param seconds:
+        :return:
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._updated = self._paused_until
+
+
+class BroadcastReport(NamedTuple):
+    """
+    广播结果
+    """
+    total: int
+    sent: int
+    failed: int
+    retries: int
+    seconds: float
+
+
+class Broadcaster:
+    """
+    广播服务。消息由少量工作线程发送，各线程复用自己的 HTTP 连接；所有广播共用同一限流器
+    """
+
+    def __init__(self, telebot: TeleBot, workers: int = 4, rate: float = 25, max_retries: int = 3):
+        """
+        :param telebot: 发送消息的 Bot
+        :param workers: 发送线程数
+        :param rate: 每秒最多发送消息数。Telegram 限制约为 30 条/秒
+        :param max_retries: 被限流（429）时的最大重试次数
+        """
+        self.bot = telebot
+        self._bucket = TokenBucket(rate)
+        self._max_retries = max_retries
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast')
+
+    def broadcast(self, users: Iterable[int], text: str, **kwargs) -> Future:
+        """
+        将广播加入发送队列，立即返回
+        :param users: 接收用户
+        :param text: 消息内容
+        :param kwargs: 传给 send_message 的其他参数
+        :return: 全部发送完成后完成的 Future，结果为 BroadcastReport
+        """
+        users = list(users)
+        metrics.set_gauge(metrics.BROADCAST_SIZE, len(users))
+        result = Future()
+        begin = time.perf_counter()
+        if len(users) == 0:
+            result.set_result(BroadcastReport(0, 0, 0, 0, 0.0))
+            return result
+
+        outcomes = []
+        lock = threading.Lock()
+
+        def on_done(future: Future):
+            with lock:
+                outcomes.append(future.result())
+                if len(outcomes) < len(users):
+                    return
+            sent = sum(1 for ok, __ in outcomes if ok)
+            report = BroadcastReport(total=len(users), sent=sent, failed=len(users) - sent,
+                                     retries=sum(retries for __, retries in outcomes),
+                                     seconds=time.perf_counter() - begin)
+            metrics.set_gauge(metrics.BROADCAST_SECONDS, report.seconds)
+            logger.info('广播完成：成功 %d/%d 条，重试 %d 次，用时 %.2fs',
+                        report.sent, report.total, report.retries, report.seconds)
+            result.set_result(report)
+
+        for uid in users:
+            self._executor.submit(self._send, uid, text, kwargs).add_done_callback(on_done)
+        return result
+
+    def _send(self, uid: int, text: str, kwargs: dict) -> Tuple[bool, int]:
+        """
+        发送一条消息
+        :return: 是否成功，重试次数
+        """
+        retries = 0
+        while True:
+            self._bucket.acquire()
+            try:
+                self.bot.send_message(uid, text, **kwargs)
+                metrics.inc(metrics.BROADCAST_MESSAGES)
+                return True, retries
+            except ApiTelegramException as e:
+                if e.error_code == 429 and retries < self._max_retries:
+                    # 服务端要求等待，暂停所有发送
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                    logger.warning('广播被限流，%s 秒后重试', retry_after)
+                    self._bucket.pause(retry_after)
+                    retries += 1
+                    continue
+                logger.warning('向 %s 发送广播失败', uid, exc_info=e)
+            except Exception as e:
+                logger.warning('向 %s 发送广播失败', uid, exc_info=e)
+            metrics.inc(metrics.BROADCAST_FAILED)
+            return False, retries
+
+    def shutdown(self, wait: bool = True):
+        """
+        发送完已加入队列的消息后停止
+        :param wait: 是否等待发送完成
+        :return:
+        """
+        self._executor.shutdown(wait=wait)
+
+
+def get_broadcaster() -> Broadcaster:
+    """
+    获得共享的广播服务。重载配置后仍沿用，以保证全局限流
+    :return:
+    """
+    global _broadcaster
+    with _broadcaster_lock:
+        if _broadcaster is None:
+            from beancount_bot.bot import bot
+            _broadcaster = Broadcaster(bot,
+                                       workers=get_config('broadcast.workers', 4),
+                                       rate=get_config('broadcast.rate', 25),
+                                       max_retries=get_config('broadcast.max_retries', 3))
+        return _broadcaster
@@ -1,11 +1,13 @@
-import os
+from concurrent.futures import Future
 from typing import List
 
 import schedule
 from telebot import TeleBot
 
-from beancount_bot.session import all_user
+from beancount_bot.command_pool import get_command_pool
+from beancount_bot.i18n import _
 from beancount_bot.task import ScheduleTask
+from beancount_bot.util import logger
 
 
 class DailyCommandTask(ScheduleTask):
@@ -13,24 +15,39 @@ class DailyCommandTask(ScheduleTask):
     每日执行指令任务
     """
 
-    def __init__(self, time: str, commands: List[str], message: str):
+    def __init__(self, time: str, commands: List[str], message: str, timeout: float = None,
+                 parallel: bool = False):
         """
         :param time: 每日更新时间
         :param commands: 执行指令
         :param message: 执行完成后发送信息
+        :param timeout: 每条指令的超时时间（秒）。为 None 则不限制
+        :param parallel: 指令间互不依赖时，可并行执行
         """
         super().__init__()
         self.time = time
         self.commands = commands
         self.message = message
+        self.timeout = timeout
+        self.parallel = parallel
 
     def register(self, fire: callable):
         schedule.every().day.at(self.time).do(fire)
 
-    def trigger(self, bot: TeleBot):
-        # 执行指令
-        for cmd in self.commands:
-            os.system(cmd)
-        # 发送信息
-        for uid in all_user():
-            bot.send_message(uid, self.message)
+    def trigger(self, bot: TeleBot) -> Future:
+        # 在子进程池中执行指令，完成后发送信息
+        result = Future()
+
+        def on_done(future: Future):
+            try:
+                # 广播给所有用户，不包含指令内容
+                results = future.result()
+                summary = '\n'.join(r.summary(_("第 {n} 条指令").format(n=i)) for i, r in enumerate(results, 1))
+                self.broadcast(_("{message}\n\n{summary}").format(message=self.message, summary=summary))
+                result.set_result(results)
+            except Exception as e:
+                logger.error('执行任务失败', exc_info=e)
+                result.set_exception(e)
+
+        get_command_pool().run(self.commands, parallel=self.parallel, timeout=self.timeout).add_done_callback(on_done)
+        return result
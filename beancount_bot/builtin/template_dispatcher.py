@@ -1,23 +1,30 @@
 import datetime
-import itertools
-from typing import List, Mapping
+import re
+import textwrap
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple, Union
 
 import yaml
+from beancount.core import amount, data
+from beancount.core.data import Transaction
+from beancount.core.number import D, MISSING
 
-from beancount_bot.dispatcher import Dispatcher
+from beancount_bot.dispatcher import Dispatcher, ParseContext
 from beancount_bot.i18n import _
 from beancount_bot.transaction import NotMatchException
 from beancount_bot.util import logger
 
-_CH_CLASS = [' ', '\"', '\\', '<']
-_STATE_MAT = [
-    # 空, ", \, <, 其他字符
-    [0, 2, -1, 4, 1],  # 0: 空格
-    [0, 2, -1, 4, 1],  # 1: 词
-    [2, 0, 3, 2, 2],  # 2: 字符串
-    [2, 2, 2, 2, 2],  # 3: 转义
-    [0, 2, -1, -1, 1],  # 4: 符号
-]
+# 词法单元。输入中每个位置都恰好能匹配其一，依次为：
+#   1. 空格
+#   2. 词：不含空格、双引号、反斜杠、< 的连续字符
+#   3. 符号 <，不可连续出现
+#   4. 字符串：双引号包裹，其中可以使用反斜杠转义任意字符
+#   5. 未闭合的双引号
+#   6. 字符串外的反斜杠
+_RE_TOKEN = re.compile(r' +|([^ "\\<]+)|(<)|"([^"\\]*(?:\\.[^"\\]*)*)"|(")|(\\)', re.S)
+_RE_ESCAPE = re.compile(r'\\(.)', re.S)
+
+# 解析上下文中 split_command 结果的 key
+CTX_WORDS = 'template.words'
 
 
 def split_command(cmd):
@@ -26,31 +33,25 @@ def split_command(cmd):
     :param cmd:
     :return:
     """
-    state = 0
     words: List[str] = []
+    after_symbol = False
 
-    for i in range(len(cmd)):
-        ch = cmd[i]
-        # 字符类
-        if ch in _CH_CLASS:
-            ch_class = _CH_CLASS.index(ch)
-        else:
-            ch_class = 4
-        # 状态转移
-        state, old_state = _STATE_MAT[state][ch_class], state
-        if state == -1:
-            raise ValueError(_("位置 {pos}：语法错误！不应出现符号 {ch}。").format(pos=i, ch=ch))
-        # 进入事件
-        if state != old_state and old_state != 3:
-            if state in [1, 2, 4]:
-                words.append('')
-            if state in [2, 3]:
-                continue
-        # 状态事件
-        if state != 0:
-            words[-1] += ch
-    if state not in [0, 1, 4]:
-        raise ValueError(_("位置 {pos}：语法错误！字符串、转义未结束。").format(pos=len(cmd)))
+    for m in _RE_TOKEN.finditer(cmd):
+        word, symbol, string, quote, backslash = m.groups()
+        if word is not None:
+            words.append(word)
+        elif symbol is not None:
+            if after_symbol:
+                raise ValueError(_("位置 {pos}：语法错误！不应出现符号 {ch}。").format(pos=m.start(), ch=symbol))
+            words.append(symbol)
+        elif string is not None:
+            # 以转义字符切分后拼接，即去除转义用的反斜杠
+            words.append(''.join(_RE_ESCAPE.split(string)) if '\\' in string else string)
+        elif quote is not None:
+            raise ValueError(_("位置 {pos}：语法错误！字符串、转义未结束。").format(pos=len(cmd)))
+        elif backslash is not None:
+            raise ValueError(_("位置 {pos}：语法错误！不应出现符号 {ch}。").format(pos=m.start(), ch=backslash))
+        after_symbol = symbol is not None
     return words
 
 
@@ -85,6 +86,133 @@ def print_one_usage(template: Template) -> str:
     return usage
 
 
+_RE_PLACEHOLDER = re.compile(r'\{([^{}]+)\}')
+
+
+class CompiledTemplate:
+    """
+    载入时预编译的模板
+    """
+
+    def __init__(self, template: Template):
+        self.template = template
+        # 待计算参数编译为代码对象
+        computed = template.get('computed', {})
+        self.computed = [(k, compile(expr, f'<computed {k}>', 'eval')) for k, expr in computed.items()]
+        # 模板切分为文本、变量名交替的片段
+        self.parts: List[str] = _RE_PLACEHOLDER.split(template['template'])
+        # 结构简单的模板可直接构建交易
+        self.builder = TransactionBuilder.compile(template['template'])
+
+    def render(self, arg_map: Mapping) -> str:
+        """
+        进行模板替换。不存在的变量原样保留
+        :param arg_map:
+        :return:
+        """
+        return _render_parts(self.parts, arg_map)
+
+
+def _render_parts(parts: List[str], arg_map: Mapping) -> str:
+    parts = parts[:]
+    for i in range(1, len(parts), 2):
+        k = parts[i]
+        parts[i] = str(arg_map[k]) if k in arg_map else f'{{{k}}}'
+    return ''.join(parts)
+
+
+# 可直接构建的模板结构：交易头、若干过账行
+_RE_TX_HEADER = re.compile(r'(\S+)[ \t]+([*!])(?:[ \t]+"([^"\\]*)")?[ \t]+"([^"\\]*)"[ \t]*')
+_RE_TX_POSTING = re.compile(r'[ \t]+(\S+)(?:[ \t]+(\S+)[ \t]+(\S+))?[ \t]*')
+# 替换后的值校验。仅接受解析器必然接受且结果相同的写法，其余交由解析器处理
+_RE_DATE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})')
+_RE_STRING = re.compile(r'[^"\\\n]*')
+_RE_ACCOUNT = re.compile(r'(?:Assets|Liabilities|Equity|Income|Expenses)(?::[A-Z0-9][A-Za-z0-9\-]*)+')
+_RE_NUMBER = re.compile(r'-?[0-9]+(?:\.[0-9]+)?')
+_RE_CURRENCY = re.compile(amount.CURRENCY_RE)
+
+
+class TransactionBuilder:
+    """
+    由模板直接构建交易，跳过 beancount 语法解析。仅支持如下结构的模板：
+      日期 标记 ["收款人"] "描述"
+        账户 [数量 货币]
+        ...
+    """
+
+    def __init__(self, header, postings):
+        self.header = header
+        self.postings = postings
+
+    @staticmethod
+    def compile(template: str) -> Optional['TransactionBuilder']:
+        """
+        编译模板
+        :param template: 模板内容
+        :return: 模板结构不支持时返回 None
+        """
+        header = None
+        postings = []
+        for lineno, line in enumerate(textwrap.dedent(template).split('\n'), 1):
+            if line.strip() == '':
+                continue
+            if header is None:
+                m = _RE_TX_HEADER.fullmatch(line)
+                if m is None:
+                    return None
+                date, flag, payee, narration = m.groups()
+                header = (lineno, _RE_PLACEHOLDER.split(date), flag,
+                          None if payee is None else _RE_PLACEHOLDER.split(payee),
+                          _RE_PLACEHOLDER.split(narration))
+                continue
+            m = _RE_TX_POSTING.fullmatch(line)
+            if m is None:
+                return None
+            postings.append((lineno, *[None if g is None else _RE_PLACEHOLDER.split(g) for g in m.groups()]))
+        if header is None:
+            return None
+        return TransactionBuilder(header, postings)
+
+    def build(self, arg_map: Mapping) -> Optional[Transaction]:
+        """
+        构建交易
+        :param arg_map: 模板参数
+        :return: 替换结果需由解析器校验时返回 None
+        """
+        lineno, date, flag, payee, narration = self.header
+        m = _RE_DATE.fullmatch(_render_parts(date, arg_map))
+        if m is None:
+            return None
+        try:
+            date = datetime.date(*map(int, m.groups()))
+        except ValueError:
+            return None
+        if payee is not None:
+            payee = _render_parts(payee, arg_map)
+            if _RE_STRING.fullmatch(payee) is None:
+                return None
+        narration = _render_parts(narration, arg_map)
+        if _RE_STRING.fullmatch(narration) is None:
+            return None
+        postings = []
+        for posting_lineno, account, number, currency in self.postings:
+            account = _render_parts(account, arg_map)
+            if _RE_ACCOUNT.fullmatch(account) is None:
+                return None
+            units = MISSING
+            if number is not None:
+                number = _render_parts(number, arg_map)
+                currency = _render_parts(currency, arg_map)
+                if _RE_NUMBER.fullmatch(number) is None or _RE_CURRENCY.fullmatch(currency) is None:
+                    return None
+                # 与解析器一致：负号作为一元运算处理
+                units = amount.Amount(-D(number[1:]) if number[0] == '-' else D(number), currency)
+            postings.append(data.Posting(account, units, None, None, None,
+                                         data.new_metadata('<string>', posting_lineno)))
+        return Transaction(data.new_metadata('<string>', lineno), date, flag, payee, narration,
+                           data.EMPTY_SET, data.EMPTY_SET, postings)
+
+
 class TemplateDispatcher(Dispatcher):
     """
     模板处理器。通过 Json 模板生成交易信息。
@@ -113,33 +241,73 @@ class TemplateDispatcher(Dispatcher):
                  '默认账户：{default_account}\n支持的账户：\n{account_alias}') \
             .format(command_usage=command_usage, default_account=default_account, account_alias=account_alias)
 
-    def __init__(self, template_config: str):
+    def __init__(self, template_config: str, structured: bool = True):
         """
         :param template_config: 模板配置文件路径。具体语法参见 template.example.yml
+        :param structured: 是否对结构简单的模板直接构建交易，跳过语法解析
         """
         super().__init__()
+        self.structured = structured
         with open(template_config, 'r', encoding='utf-8') as f:
             data = yaml.full_load(f)
         self.config = data['config']
         self.templates = data['templates']
+        # 指令名 -> 模板。指令名重复时使用先定义的模板
+        self.commands: Dict[str, CompiledTemplate] = {}
+        for template in self.templates:
+            compiled = CompiledTemplate(template)
+            for command in _to_list(template['command']):
+                self.commands.setdefault(command, compiled)
+
+    def keywords(self) -> Optional[Iterable[str]]:
+        return self.commands.keys()
+
+    def route_key(self, ctx: ParseContext) -> Optional[str]:
+        words = ctx.memo(CTX_WORDS, split_command)
+        return words[0] if len(words) > 0 else None
 
     def quick_check(self, input_str: str) -> bool:
-        words = split_command(input_str)
-        prefixes = map(lambda t: _to_list(t['command']), self.templates)
-        prefixes = itertools.chain(*prefixes)
+        return self._check_words(split_command(input_str))
+
+    def quick_check_ctx(self, ctx: ParseContext) -> bool:
+        return self._check_words(ctx.memo(CTX_WORDS, split_command))
+
+    def _check_words(self, words: List[str]) -> bool:
         # 开头相同且有空格隔开
-        return any(map(lambda prefix: words[0] == prefix, prefixes))
+        return len(words) > 0 and words[0] in self.commands
+
+    def process(self, input_str: str) -> Union[Transaction, str]:
+        return self.process_ctx(ParseContext(input_str))
+
+    def process_ctx(self, ctx: ParseContext) -> Union[Transaction, str]:
+        tx = self.process_raw_ctx(ctx)
+        # 无法直接构建时，由解析器校验生成的语法
+        return self._parse_raw(tx) if isinstance(tx, str) else tx
+
+    def process_raw_ctx(self, ctx: ParseContext) -> Union[Transaction, str]:
+        compiled, arg_map = self._prepare(ctx.memo(CTX_WORDS, split_command))
+        if self.structured and compiled.builder is not None:
+            tx = compiled.builder.build(arg_map)
+            if tx is not None:
+                return tx
+        return compiled.render(arg_map)
 
     def _process_raw(self, input_str: str) -> str:
-        words = split_command(input_str)
+        compiled, arg_map = self._prepare(split_command(input_str))
+        return compiled.render(arg_map)
+
+    def _prepare(self, words: List[str]) -> Tuple[CompiledTemplate, dict]:
+        """
+        由切分后的指令选择模板并计算模板参数
+        :param words:
+        :return: 模板、模板参数
+        """
         cmd, args = words[0], words[1:]
         # 选择模板
-        template = next(
-            filter(lambda t: cmd in _to_list(t['command']), self.templates),
-            None
-        )
-        if template is None:
+        compiled = self.commands.get(cmd)
+        if compiled is None:
             raise NotMatchException()
+        template = compiled.template
         # 默认参数
         arg_map = {
             'account': self.config['default_account'],
@@ -171,12 +339,7 @@ class TemplateDispatcher(Dispatcher):
         if len(args) != 0:
             raise ValueError(_("参数过多！语法：{syntax}").format(syntax=print_one_usage(template)))
         # 计算待计算参数
-        if 'computed' in template:
-            for k, expr in template['computed'].items():
-                arg_map[k] = eval(expr, None, arg_map)
-        # 进行模板替换
+        for k, code in compiled.computed:
+            arg_map[k] = eval(code, None, arg_map)
         logger.debug('模板参数 %s', arg_map)
-        ret = template['template']
-        for k, v in arg_map.items():
-            ret = ret.replace(f'{{{k}}}', str(v))
-        return ret
+        return compiled, arg_map
@@ -0,0 +1,171 @@
+import collections
+import io
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+from beancount_bot.config import get_config
+from beancount_bot.i18n import _
+from beancount_bot.util import logger
+
+_command_pool: Optional['CommandPool'] = None
+_command_pool_lock = threading.Lock()
+
+
+class CommandResult(NamedTuple):
+    """
+    指令执行结果
+    """
+    command: str
+    returncode: Optional[int]
+    seconds: float
+    timed_out: bool
+    output: str
+
+    @property
+    def ok(self) -> bool:
+        return not self.timed_out and self.returncode == 0
+
+    def summary(self, name: str = None) -> str:
+        """
+        一行执行结果摘要
+        :param name: 摘要中指令的名称。默认为指令本身
+        :return:
+        """
+        if self.timed_out:
+            status = _("超时")
+        elif self.returncode == 0:
+            status = _("成功")
+        else:
+            status = _("失败（退出码 {code}）").format(code=self.returncode)
+        return _("{status}：{command}（{seconds:.1f}s）").format(
+            status=status, command=name if name is not None else self.command, seconds=self.seconds)
+
+
+class CommandPool:
+    """
+    子进程执行池。同时运行的指令数有上限，指令输出逐行写入日志
+    """
+
+    def __init__(self, max_processes: int = 2, output_lines: int = 20):
+        """
+        :param max_processes: 同时运行的最大子进程数
+        :param output_lines: 结果中保留的末尾输出行数
+        """
+        self._output_lines = output_lines
+        self._executor = ThreadPoolExecutor(max_workers=max_processes, thread_name_prefix='command')
+
+    def run(self, commands: List[str], parallel: bool = False, timeout: float = None) -> Future:
+        """
+        执行指令，立即返回
+        :param commands: 指令列表
+        :param parallel: 是否并行执行。为 False 则按顺序逐条执行
+        :param timeout: 每条指令的超时时间（秒），超时将终止该指令。为 None 则不限制
+        :return: 全部执行完成后完成的 Future，结果为按指令顺序排列的 CommandResult 列表
+        """
+        if not parallel:
+            return self._executor.submit(lambda: [self._execute(cmd, timeout) for cmd in commands])
+
+        result = Future()
+        futures = [self._executor.submit(self._execute, cmd, timeout) for cmd in commands]
+        if len(futures) == 0:
+            result.set_result([])
+            return result
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def on_done(__):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                result.set_result([f.result() for f in futures])
+            except Exception as e:
+                result.set_exception(e)
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return result
+
+    def _execute(self, command: str, timeout: float = None) -> CommandResult:
+        """
+        在当前线程中执行一条指令
+        :param command:
+        :param timeout:
+        :return:
+        """
+        logger.info('执行指令：%s', command)
+        begin = time.perf_counter()
+        proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                stdin=subprocess.DEVNULL, start_new_session=os.name == 'posix')
+        # 以系统编码解码输出，无法解码的字节不中断执行（Popen 的 errors 参数需要 Python 3.7）
+        stdout = io.TextIOWrapper(proc.stdout, errors='replace')
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            logger.warning('指令超时，终止执行：%s', command)
+            _kill(proc)
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+        output = collections.deque(maxlen=self._output_lines)
+        try:
+            for line in stdout:
+                line = line.rstrip('\n')
+                output.append(line)
+                logger.info('[%s] %s', command, line)
+            returncode = proc.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            stdout.close()
+        result = CommandResult(command=command, returncode=returncode, seconds=time.perf_counter() - begin,
+                               timed_out=timed_out.is_set(), output='\n'.join(output))
+        logger.info('指令执行结束：%s', result.summary())
+        return result
+
+    def shutdown(self, wait: bool = True):
+        """
+        执行完已提交的指令后停止
+        :param wait: 是否等待执行完成
+        :return:
+        """
+        self._executor.shutdown(wait=wait)
+
+
+def _kill(proc: subprocess.Popen):
+    """
+    终止子进程及其启动的所有进程，以免 shell 启动的子进程继续占用输出管道
+    :param proc:
+    :return:
+    """
+    try:
+        if os.name == 'posix':
+            # 子进程以 start_new_session 启动，进程组号即其进程号
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(proc.pid)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+
+def get_command_pool() -> CommandPool:
+    """
+    获得共享的子进程执行池
+    :return:
+    """
+    global _command_pool
+    with _command_pool_lock:
+        if _command_pool is None:
+            _command_pool = CommandPool(max_processes=get_config('task.max_processes', 2))
+        return _command_pool
@@ -1,8 +1,12 @@
+import threading
+
 import yaml
 
 from beancount_bot.i18n import _
 
 global_object_map = {}
+# 全局对象可能在多个处理器线程中同时创建
+_global_lock = threading.RLock()
 
 GLOBAL_CONFIG = 'config'
 GLOBAL_MANAGER = 'manager'
@@ -30,9 +34,13 @@ def get_global(key: str, default_producer: callable):
     :return:
     """
     global global_object_map
-    if key not in global_object_map:
-        set_global(key, default_producer())
-    return global_object_map[key]
+    obj_map = global_object_map
+    if key in obj_map:
+        return obj_map[key]
+    with _global_lock:
+        if key not in global_object_map:
+            set_global(key, default_producer())
+        return global_object_map[key]
 
 
 def load_config(path=None):
@@ -46,8 +54,15 @@ def load_config(path=None):
     global global_object_map
     with open(path, 'r', encoding='utf-8') as f:
         data = yaml.full_load(f)
-    global_object_map = {}
-    set_global(GLOBAL_CONFIG, data)
+    with _global_lock:
+        old_objects = global_object_map
+        global_object_map = {}
+        set_global(GLOBAL_CONFIG, data)
+    # 停止被替换对象的后台工作，如账本管理对象的写入线程与压缩定时器
+    for obj in old_objects.values():
+        close = getattr(obj, 'close', None)
+        if callable(close):
+            close()
 
 
 def get_config_obj():
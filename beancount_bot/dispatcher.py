@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 from beancount.core.data import Transaction
 from beancount.parser import parser
@@ -7,6 +7,33 @@ from beancount_bot.i18n import _
 from beancount_bot.util import stringify_errors, indent
 
 
+class ParseContext:
+    """
+    单条消息的解析上下文。由 TransactionManager 创建，在处理器间共享由用户输入派生的数据
+    """
+
+    def __init__(self, input_str: str) -> None:
+        self.input_str = input_str
+        self._cache: Dict[str, tuple] = {}
+
+    def memo(self, key: str, producer: Callable[[str], object]):
+        """
+        获得派生数据。同一 key 只在首次获取时调用 producer 计算，抛出的异常同样会被缓存
+        :param key: 数据名。不同处理器使用同一 key 时，producer 应当等价
+        :param producer: 以用户输入为参数计算数据
+        :return:
+        """
+        if key not in self._cache:
+            try:
+                self._cache[key] = (producer(self.input_str), None)
+            except Exception as e:
+                self._cache[key] = (None, e)
+        value, error = self._cache[key]
+        if error is not None:
+            raise error
+        return value
+
+
 class Dispatcher:
     """
     交易语句处理器
@@ -28,6 +55,33 @@ class Dispatcher:
         """
         return True
 
+    def keywords(self) -> Optional[Iterable[str]]:
+        """
+        声明处理器能处理的消息关键词，用于构建路由表。在构建 TransactionManager 时调用一次
+        声明后，关键词（见 route_key）不在其中的消息将不会交由此处理器处理
+        :return: 关键词集合。返回 None 表示不声明，所有消息都将按顺序尝试此处理器
+        """
+        return None
+
+    def route_key(self, ctx: ParseContext) -> Optional[str]:
+        """
+        计算消息的关键词。仅在声明了 keywords 时使用
+        默认为第一个空白分隔的词。同类处理器对同一消息只会计算一次
+        :param ctx: 解析上下文
+        :return: 关键词
+        """
+        words = ctx.input_str.split(maxsplit=1)
+        return words[0] if len(words) > 0 else None
+
+    def quick_check_ctx(self, ctx: ParseContext) -> bool:
+        """
+        同 quick_check，可以使用上下文中缓存的派生数据
+        默认调用 quick_check
+        :param ctx: 解析上下文
+        :return: 用户输入是否可被处理器处理
+        """
+        return self.quick_check(ctx.input_str)
+
     def process(self, input_str: str) -> Union[Transaction, str]:
         """
         解析输入为交易。若输入不合规，则抛出 ValueError
@@ -36,7 +90,38 @@ class Dispatcher:
         :return: 如果解析为交易，返回 Transaction；否则返回符合 beancount 语法的字符串
         :raise NotMatchException: 用户输入不可被处理器处理
         """
-        tx_str = self._process_raw(input_str)
+        return self._parse_raw(self._process_raw(input_str))
+
+    def process_ctx(self, ctx: ParseContext) -> Union[Transaction, str]:
+        """
+        同 process，可以使用上下文中缓存的派生数据
+        默认调用 process。重载时可以直接构建并返回 Transaction，跳过语法解析
+        :param ctx: 解析上下文
+        :return: 如果解析为交易，返回 Transaction；否则返回符合 beancount 语法的字符串
+        :raise NotMatchException: 用户输入不可被处理器处理
+        """
+        return self.process(ctx.input_str)
+
+    def process_raw_ctx(self, ctx: ParseContext) -> Union[Transaction, str]:
+        """
+        批量模式下处理输入。返回的 beancount 语法不在此解析，由调用方与同批语句一同解析校验
+        默认返回 _process_raw 的结果；若处理器重载了 process 或 process_ctx，则调用 process_ctx
+        :param ctx: 解析上下文
+        :return: 直接构建的 Transaction，或未经解析的 beancount 语法
+        :raise NotMatchException: 用户输入不可被处理器处理
+        """
+        clazz = type(self)
+        if clazz.process is not Dispatcher.process or clazz.process_ctx is not Dispatcher.process_ctx:
+            # 处理逻辑不在 _process_raw 中，不能跳过
+            return self.process_ctx(ctx)
+        return self._process_raw(ctx.input_str)
+
+    def _parse_raw(self, tx_str: str) -> Union[Transaction, str]:
+        """
+        解析 beancount 语法。若存在语法错误，则抛出 ValueError
+        :param tx_str: _process_raw 的结果
+        :return: 如果解析为交易，返回 Transaction；否则返回原字符串
+        """
         # 解析结果
         entries, errors, __ = parser.parse_string(tx_str, dedent=True)
         if len(errors) > 0:
@@ -81,3 +166,46 @@ class Dispatcher:
         :return:
         """
         return _("暂无帮助信息。")
+
+
+class DispatcherRouter:
+    """
+    处理器路由表。根据处理器声明的关键词，将消息直接交给候选处理器
+    """
+
+    def __init__(self, dispatchers: List[Dispatcher]) -> None:
+        self.dispatchers = dispatchers
+        # 未声明关键词的处理器
+        self._fallback: List[int] = []
+        # 按 route_key 实现分组：(计算关键词的处理器, 关键词 -> 处理器序号)
+        self._groups: List[Tuple[Dispatcher, Dict[str, List[int]]]] = []
+        groups = {}
+        for i, dispatcher in enumerate(dispatchers):
+            keywords = dispatcher.keywords()
+            if keywords is None:
+                self._fallback.append(i)
+                continue
+            key_func = type(dispatcher).route_key
+            if key_func not in groups:
+                groups[key_func] = (dispatcher, {})
+            table = groups[key_func][1]
+            for keyword in keywords:
+                table.setdefault(keyword, []).append(i)
+        self._groups = list(groups.values())
+
+    def candidates(self, ctx: ParseContext) -> List[Dispatcher]:
+        """
+        获得可能处理该消息的处理器，保持配置顺序
+        :param ctx: 解析上下文
+        :return:
+        """
+        if len(self._groups) == 0:
+            return self.dispatchers
+        indexes = list(self._fallback)
+        try:
+            for dispatcher, table in self._groups:
+                indexes += table.get(dispatcher.route_key(ctx), [])
+        except ValueError:
+            # 无法计算关键词，按顺序尝试所有处理器，由处理器报告错误
+            return self.dispatchers
+        return [self.dispatchers[i] for i in sorted(set(indexes))]
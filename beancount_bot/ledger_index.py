@@ -0,0 +1,370 @@
+import mmap
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from beancount_bot.util import logger
+
+INDEX_SUFFIX = '.tgbot_index'
+# 压缩账本时的临时文件
+COMPACT_SUFFIX = '.compact'
+# 写入索引时的临时文件
+INDEX_TMP_SUFFIX = INDEX_SUFFIX + '.tmp'
+
+Range = Tuple[int, int]
+Stamp = Tuple[int, int]
+
+# 与 transaction.META_UUID 对应
+_RE_META_UUID = re.compile(rb'^[ \t]+tgbot_uuid:[ \t]*"([^"]+)"')
+_RE_MARKER = re.compile(rb'^;[ \t]*TGBOT_(START|END)[ \t]+(\S+)')
+_TOMBSTONE = b'; TGBOT_DEL '
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def scan_ledger(bean_file: str) -> Tuple[Dict[str, Range], int]:
+    """
+    扫描账本文件，获得所有由机器人创建的语句的字节区间
+    交易区间为交易首行至最后一个缩进行；注释包裹语句区间为 TGBOT_START 行至 TGBOT_END 行
+    :param bean_file:
+    :return: uuid -> [起始, 结束)，已撤回内容的字节数
+    """
+    entries: Dict[str, Range] = {}
+    opened: Dict[str, int] = {}
+    dead_bytes = 0
+    offset = 0
+    start, end, tx_uuid = None, 0, None
+    with open(bean_file, 'rb') as f:
+        for line in f:
+            if line[:1] in (b' ', b'\t') and line.strip():
+                # 缩进行属于当前指令
+                if start is not None:
+                    end = offset + len(line)
+                    if tx_uuid is None:
+                        m = _RE_META_UUID.match(line)
+                        if m:
+                            tx_uuid = m.group(1).decode('utf-8')
+            else:
+                # 新指令开始，结束当前指令
+                if tx_uuid is not None:
+                    entries[tx_uuid] = (start, end)
+                tx_uuid = None
+                start = offset if line[:1].isdigit() else None
+                if line.startswith(_TOMBSTONE):
+                    dead_bytes += len(line)
+                elif line[:1] == b';':
+                    m = _RE_MARKER.match(line)
+                    if m:
+                        kind, marker_uuid = m.group(1), m.group(2).decode('utf-8')
+                        if kind == b'START':
+                            opened[marker_uuid] = offset
+                        elif marker_uuid in opened:
+                            entries[marker_uuid] = (opened.pop(marker_uuid), offset + len(line))
+            offset += len(line)
+    if tx_uuid is not None:
+        entries[tx_uuid] = (start, end)
+    return entries, dead_bytes
+
+
+def find_comment_wrapped(bean_file: str, tx_uuid: str) -> Optional[Tuple[int, int, int, int]]:
+    """
+    在内存映射的账本中单次扫描查找注释包裹的语句
+    :param bean_file:
+    :param tx_uuid:
+    :return: (TGBOT_START 行首, 语句起始, 语句结束, TGBOT_END 行尾)，不存在则返回 None
+    """
+    start_mark = f'TGBOT_START {tx_uuid}'.encode('utf-8')
+    end_mark = f'TGBOT_END {tx_uuid}'.encode('utf-8')
+    with open(bean_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.find(start_mark)
+            if pos == -1:
+                return None
+            end_pos = mm.find(end_mark, pos + len(start_mark))
+            if end_pos == -1:
+                return None
+            # 扩展至整行
+            block_start = mm.rfind(b'\n', 0, pos) + 1
+            inner_start = mm.find(b'\n', pos, end_pos) + 1
+            inner_end = mm.rfind(b'\n', 0, end_pos) + 1
+            block_end = mm.find(b'\n', end_pos)
+            block_end = len(mm) if block_end == -1 else block_end + 1
+    if inner_start == 0 or inner_end < inner_start:
+        # 起止标记位于同一行
+        return None
+    return block_start, inner_start, inner_end, block_end
+
+
+def splice_file(bean_file: str, start: int, end: int) -> bytes:
+    """
+    原地删除文件中 [start, end) 区间，只移动区间之后的内容
+    :param bean_file:
+    :param start:
+    :param end:
+    :return: 被删除的内容
+    """
+    with open(bean_file, 'r+b') as f:
+        f.seek(start)
+        removed = f.read(end - start)
+        # 分块前移尾部内容
+        read_pos, write_pos = end, start
+        while True:
+            f.seek(read_pos)
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            f.seek(write_pos)
+            f.write(chunk)
+            read_pos += len(chunk)
+            write_pos += len(chunk)
+        f.truncate(write_pos)
+    return removed
+
+
+def tombstone_file(bean_file: str, start: int, end: int, tx_uuid: str) -> Optional[bytes]:
+    """
+    原地将文件中 [start, end) 区间覆盖为等长的撤回标记注释，不改变其他内容的位置
+    :param bean_file:
+    :param start:
+    :param end: 区间应以换行结尾
+    :param tx_uuid:
+    :return: 被覆盖的内容。区间过短无法放下标记时不做修改，返回 None
+    """
+    mark = _TOMBSTONE + tx_uuid.encode('utf-8')
+    if end - start < len(mark) + 1:
+        return None
+    with open(bean_file, 'r+b') as f:
+        f.seek(start)
+        removed = f.read(end - start)
+        f.seek(start)
+        f.write(mark.ljust(end - start - 1) + b'\n')
+    return removed
+
+
+def compact_file(bean_file: str):
+    """
+    去除文件中的撤回标记。写入临时文件后原子替换原文件
+    :param bean_file:
+    """
+    tmp_file = bean_file + COMPACT_SUFFIX
+    with open(bean_file, 'rb') as src, open(tmp_file, 'wb') as dst:
+        for line in src:
+            if not line.startswith(_TOMBSTONE):
+                dst.write(line)
+        dst.flush()
+        os.fsync(dst.fileno())
+    shutil.copymode(bean_file, tmp_file)
+    os.replace(tmp_file, bean_file)
+
+
+def read_range(bean_file: str, start: int, end: int) -> bytes:
+    """
+    读取文件的 [start, end) 区间
+    """
+    with open(bean_file, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+class LedgerIndex:
+    """
+    账本索引。记录 uuid -> 字节区间，以追加日志的形式保存于账本旁的 sidecar 文件
+    日志格式（每行一条）：
+      + uuid 起始 结束    添加语句
+      - uuid 移位         删除语句，其后语句前移“移位”字节。移位为 0 表示语句被原地标记为撤回
+      ~ 字节数            已撤回、等待压缩的字节数
+      = 大小 修改时间      账本文件状态，用于校验索引是否过期
+    """
+
+    def __init__(self, bean_file: str):
+        self.bean_file = bean_file
+        self.index_file = bean_file + INDEX_SUFFIX
+        self.entries: Dict[str, Range] = {}
+        # 已标记撤回、等待压缩的字节数
+        self.dead_bytes = 0
+        self._stamp: Optional[Stamp] = None
+        self._load()
+
+    def _file_stamp(self) -> Stamp:
+        try:
+            st = os.stat(self.bean_file)
+        except FileNotFoundError:
+            return 0, 0
+        return st.st_size, st.st_mtime_ns
+
+    def _load(self):
+        """
+        从 sidecar 文件回放索引
+        """
+        if not os.path.exists(self.index_file):
+            return
+        lines = 0
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self._replay(line.split())
+                    lines += 1
+        except (OSError, ValueError, IndexError) as e:
+            logger.warning('账本索引 %s 损坏，将重建：%s', self.index_file, e)
+            self.entries, self.dead_bytes, self._stamp = {}, 0, None
+            return
+        # 日志过长则重写
+        if lines > 4 * len(self.entries) + 16:
+            self._save()
+
+    def _replay(self, record):
+        op = record[0]
+        if op == '+':
+            self.entries[record[1]] = (int(record[2]), int(record[3]))
+        elif op == '-':
+            self._drop(record[1], int(record[2]))
+        elif op == '~':
+            self.dead_bytes = int(record[1])
+        elif op == '=':
+            self._stamp = (int(record[1]), int(record[2]))
+        else:
+            raise ValueError(f'未知记录 {op}')
+
+    def _drop(self, tx_uuid: str, shift: int):
+        if tx_uuid not in self.entries:
+            return
+        start, end = self.entries.pop(tx_uuid)
+        if shift == 0:
+            self.dead_bytes += end - start
+            return
+        for k, (s, e) in self.entries.items():
+            if s >= end:
+                self.entries[k] = (s - shift, e - shift)
+
+    def _save(self):
+        """
+        重写 sidecar 文件
+        """
+        tmp_file = self.bean_file + INDEX_TMP_SUFFIX
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                for k, (s, e) in self.entries.items():
+                    f.write(f'+ {k} {s} {e}\n')
+                f.write(f'~ {self.dead_bytes}\n')
+                if self._stamp is not None:
+                    f.write('= {} {}\n'.format(*self._stamp))
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            logger.warning('无法保存账本索引 %s：%s', self.index_file, e)
+
+    def _append(self, *records: str):
+        try:
+            with open(self.index_file, 'a', encoding='utf-8') as f:
+                f.write(''.join(r + '\n' for r in records))
+        except OSError as e:
+            logger.warning('无法保存账本索引 %s：%s', self.index_file, e)
+
+    def refresh(self):
+        """
+        若账本文件在索引之外被修改，则重新扫描账本
+        """
+        if self._file_stamp() == self._stamp:
+            return
+        logger.info('账本索引过期，重新扫描：%s', self.bean_file)
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        重新扫描账本
+        """
+        stamp = self._file_stamp()
+        if stamp != (0, 0):
+            self.entries, self.dead_bytes = scan_ledger(self.bean_file)
+        else:
+            self.entries, self.dead_bytes = {}, 0
+        self._stamp = stamp
+        self._save()
+
+    def lookup(self, tx_uuid: str) -> Optional[Range]:
+        """
+        查找语句所在区间
+        :param tx_uuid:
+        :return: [起始, 结束)，不存在则返回 None
+        """
+        self.refresh()
+        return self.entries.get(tx_uuid)
+
+    def add(self, tx_uuid: str, rng: Range):
+        """
+        记录新追加的语句。调用前账本应当只被追加了该语句
+        :param tx_uuid:
+        :param rng:
+        """
+        self.extend([(tx_uuid, rng)])
+
+    def extend(self, ranges: List[Tuple[str, Range]]):
+        """
+        记录一批新追加的语句。调用前账本应当只被追加了这些语句
+        :param ranges: (uuid, 区间) 列表
+        """
+        records = []
+        for tx_uuid, (start, end) in ranges:
+            self.entries[tx_uuid] = (start, end)
+            records.append(f'+ {tx_uuid} {start} {end}')
+        self._stamp = self._file_stamp()
+        records.append('= {} {}'.format(*self._stamp))
+        self._append(*records)
+
+    def remove(self, tx_uuid: str, shift: int):
+        """
+        记录语句已被删除
+        :param tx_uuid:
+        :param shift: 账本中该语句之后内容前移的字节数
+        """
+        self._drop(tx_uuid, shift)
+        self._stamp = self._file_stamp()
+        self._append(f'- {tx_uuid} {shift}', '= {} {}'.format(*self._stamp))
+
+
+class ShardRegistry:
+    """
+    全局 uuid -> 账本分片文件 注册表
+    账本文件名包含 {year}、{month}、{date} 时，撤回交易可直接定位所在分片
+    """
+
+    def __init__(self):
+        self.shards: Dict[str, str] = {}
+
+    def register(self, tx_uuid: str, bean_file: str):
+        self.shards[tx_uuid] = bean_file
+
+    def unregister(self, tx_uuid: str):
+        self.shards.pop(tx_uuid, None)
+
+    def lookup(self, tx_uuid: str) -> Optional[str]:
+        """
+        查找语句所在分片
+        :param tx_uuid:
+        :return: 分片文件路径，不存在则返回 None
+        """
+        return self.shards.get(tx_uuid)
+
+    def rebuild(self, bean_files: Iterable[str], max_workers: int = None) -> Dict[str, LedgerIndex]:
+        """
+        并行载入所有分片的索引，重建注册表
+        :param bean_files: 所有分片文件
+        :param max_workers: 并行线程数
+        :return: 分片文件 -> 分片索引
+        """
+
+        def load(bean_file):
+            index = LedgerIndex(bean_file)
+            index.refresh()
+            return index
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            indexes = list(executor.map(load, bean_files))
+        self.shards = {}
+        for index in indexes:
+            for tx_uuid in index.entries:
+                self.shards[tx_uuid] = index.bean_file
+        return {index.bean_file: index for index in indexes}
@@ -0,0 +1,105 @@
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Tuple
+
+from beancount_bot.util import logger
+
+FSYNC_NONE = 'none'
+FSYNC_BATCH = 'batch'
+FSYNC_ENTRY = 'entry'
+FSYNC_POLICIES = [FSYNC_NONE, FSYNC_BATCH, FSYNC_ENTRY]
+
+# (uuid, 语句内容, 语句后附加内容)
+PendingEntry = Tuple[str, str, str]
+
+
+class LedgerWriter:
+    """
+    账本写入线程。将排队中的语句按账本文件合并为一次追加（group commit）
+    """
+
+    def __init__(self, write: Callable[[str, List[PendingEntry]], None],
+                 queue_size: int = 1024, max_batch: int = 256, idle_timeout: float = 60):
+        """
+        :param write: 实际写入函数，参数为账本文件与该文件的待写入语句
+        :param queue_size: 队列长度。队列满时 submit 将阻塞
+        :param max_batch: 单次合并的最大语句数
+        :param idle_timeout: 空闲多久后退出写入线程，有新语句时重新启动
+        """
+        self._write = write
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._max_batch = max_batch
+        self._idle_timeout = idle_timeout
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def submit(self, bean_file: str, entries: List[PendingEntry]) -> Future:
+        """
+        提交待写入语句。同次提交的语句总在同一次追加中写入
+        :param bean_file:
+        :param entries:
+        :return: 语句写入（并按策略同步）后完成的 Future
+        """
+        future = Future()
+        self._queue.put((bean_file, entries, future))
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='LedgerWriter', daemon=True)
+                self._thread.start()
+        return future
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self._idle_timeout)
+            except queue.Empty:
+                with self._thread_lock:
+                    if self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+            # 取出所有已排队的语句
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self._max_batch:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if len(batch) > 0:
+                self._commit(batch)
+            if item is None:
+                # 收到停止信号
+                return
+
+    def close(self):
+        """
+        写入已提交的语句后停止写入线程。之后再次提交将重新启动写入线程
+        :return:
+        """
+        with self._thread_lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._thread = None
+            self._queue.put(None)
+        thread.join()
+
+    def _commit(self, batch):
+        # 按账本文件分组，保持提交顺序
+        groups = {}
+        for bean_file, entries, future in batch:
+            groups.setdefault(bean_file, []).append((entries, future))
+        for bean_file, items in groups.items():
+            try:
+                self._write(bean_file, [entry for entries, __ in items for entry in entries])
+            except Exception as e:
+                logger.error('写入账本失败：%s', bean_file, exc_info=e)
+                for __, future in items:
+                    future.set_exception(e)
+            else:
+                for __, future in items:
+                    future.set_result(None)
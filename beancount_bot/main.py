@@ -1,9 +1,13 @@
+import atexit
+import signal
+import sys
+
 import click
 
 from beancount_bot import bot, config as conf, __VERSION__
 from beancount_bot.config import load_config, get_config
 from beancount_bot.i18n import _
-from beancount_bot.session import load_session
+from beancount_bot.session import load_session, flush_session
 from beancount_bot.task import load_task, start_schedule_thread
 from beancount_bot.transaction import get_manager
 from beancount_bot.util import logger
@@ -27,6 +31,9 @@ def main(config):
     # 加载会话
     logger.info("加载会话...")
     load_session()
+    # 退出时写入尚未写入的会话
+    atexit.register(flush_session)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     # 创建管理对象
     logger.info("创建管理对象...")
     get_manager()
@@ -36,7 +43,12 @@ def main(config):
     start_schedule_thread()
     # 启动
     logger.info("启动 Bot...")
-    bot.serving()
+    mode = get_config('serving.mode', 'polling')
+    if mode == 'webhook':
+        from beancount_bot.webhook import serving_webhook
+        serving_webhook()
+    else:
+        bot.serving()
 
 
 if __name__ == '__main__':
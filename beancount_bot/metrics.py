@@ -0,0 +1,67 @@
+import threading
+from typing import Dict
+
+# 已鉴权用户数
+AUTH_USERS = 'session.auth_users'
+# 最近一次广播的接收人数
+BROADCAST_SIZE = 'broadcast.size'
+# 累计广播消息数
+BROADCAST_MESSAGES = 'broadcast.messages'
+# 累计发送失败的广播消息数
+BROADCAST_FAILED = 'broadcast.failed'
+# 最近一次广播的用时（秒）
+BROADCAST_SECONDS = 'broadcast.seconds'
+# 最近一次定时任务实际执行时间与计划时间之差（秒）
+SCHEDULE_LATENESS = 'schedule.lateness'
+# 累计执行定时任务次数
+SCHEDULE_RUNS = 'schedule.runs'
+# 最近一次完成的任务用时（秒）
+TASK_SECONDS = 'task.seconds'
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+
+
+def inc(name: str, value: float = 1):
+    """
+    累加计数器
+    :param name:
+    :param value:
+    :return:
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name: str, value: float):
+    """
+    设置当前值
+    :param name:
+    :param value:
+    :return:
+    """
+    with _lock:
+        _gauges[name] = value
+
+
+def get_metric(name: str, default_value: float = 0) -> float:
+    """
+    获得指标值
+    :param name:
+    :param default_value:
+    :return:
+    """
+    with _lock:
+        if name in _gauges:
+            return _gauges[name]
+        return _counters.get(name, default_value)
+
+
+def snapshot() -> Dict[str, float]:
+    """
+    获得所有指标的当前值
+    :return:
+    """
+    with _lock:
+        return {**_counters, **_gauges}
@@ -1,28 +1,146 @@
-import json
-import os.path
+import threading
+import time
+from collections import OrderedDict
 from types import MappingProxyType
-from typing import Dict, Iterable
+from typing import Dict, List, Optional, Set, Tuple
 
+from beancount_bot import metrics
 from beancount_bot.config import get_config
+from beancount_bot.i18n import _
+from beancount_bot.session_store import SessionStore, JsonSessionStore, SqliteSessionStore
 from beancount_bot.util import logger
 
 SESS_AUTH = 'auth'
 SESS_TX_TAGS = 'tx_tags'
 
+# 会话存储后端
+SESSION_BACKEND_JSON = 'json'
+SESSION_BACKEND_SQLITE = 'sqlite'
+
+
+class TransientSessions:
+    """
+    未鉴权用户的会话。按最近使用淘汰，超过数量或时间限制即丢弃，不会持久化
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        """
+        :param max_size: 最多保留的会话数
+        :param ttl: 会话最后一次使用后保留的时间（秒）
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        # 用户 -> (最后使用时间, 会话)，按最后使用时间排列
+        self._items: Dict[str, Tuple[float, dict]] = OrderedDict()
+
+    def get(self, uid: str) -> dict:
+        """
+        获得会话，不存在则创建
+        :param uid:
+        :return:
+        """
+        now = time.monotonic()
+        sess = self.peek(uid)
+        if sess is None:
+            sess = {}
+        self._items.pop(uid, None)
+        self._items[uid] = (now, sess)
+        self._evict(now)
+        return sess
+
+    def peek(self, uid: str) -> Optional[dict]:
+        """
+        获得会话，不更新使用时间
+        :param uid:
+        :return: 不存在或已过期时返回 None
+        """
+        item = self._items.get(uid)
+        if item is None or time.monotonic() - item[0] > self.ttl:
+            return None
+        return item[1]
+
+    def pop(self, uid: str) -> Optional[dict]:
+        """
+        移除会话
+        :param uid:
+        :return: 不存在或已过期时返回 None
+        """
+        sess = self.peek(uid)
+        self._items.pop(uid, None)
+        return sess
+
+    def keys(self) -> List[str]:
+        self._evict(time.monotonic())
+        return list(self._items.keys())
+
+    def __len__(self):
+        return len(self._items)
+
+    def _evict(self, now: float):
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        while len(self._items) > 0 and now - next(iter(self._items.values()))[0] > self.ttl:
+            self._items.popitem(last=False)
+
+
+# 会话读缓存，与存储后端保持一致。只包含已鉴权（或已持久化）的用户
 _session_cache: Dict[str, dict] = {}
+# 已鉴权用户，随 SESS_AUTH 的设置更新
+_auth_users: Set[str] = set()
+_transient = TransientSessions()
+_store: Optional[SessionStore] = None
+_lock = threading.RLock()
+# 待写入的 (用户, 键)，由后台定时合并写入
+_dirty: Set[Tuple[str, str]] = set()
+_flush_interval: float = 1
+_flush_timer: Optional[threading.Timer] = None
+_flush_lock = threading.Lock()
+# 写入失败后的重试间隔（秒），连续失败时指数增长，写入成功后清零
+_retry_delay: float = 0
+_MIN_RETRY_DELAY = 1
+_MAX_RETRY_DELAY = 60
 
 
-def load_session():
+def create_store() -> SessionStore:
     """
-    从文件恢复会话数据
+    从配置创建会话存储后端
     :return:
     """
-    global _session_cache
     session_file = get_config('bot.session_file')
-    if os.path.exists(session_file):
-        with open(session_file, 'r', encoding='utf-8') as f:
-            _session_cache = json.load(f)
-        logger.debug("从文件恢复会话 %s", _session_cache)
+    backend = get_config('bot.session_backend', SESSION_BACKEND_SQLITE)
+    if backend == SESSION_BACKEND_JSON:
+        return JsonSessionStore(session_file)
+    if backend == SESSION_BACKEND_SQLITE:
+        return SqliteSessionStore(get_config('bot.session_db', f'{session_file}.db'), migrate_from=session_file)
+    raise ValueError(_("未知的会话存储后端：{backend}").format(backend=backend))
+
+
+def _get_store() -> SessionStore:
+    global _store
+    if _store is None:
+        _store = create_store()
+    return _store
+
+
+def load_session():
+    """
+    从存储后端恢复会话数据
+    :return:
+    """
+    global _session_cache, _auth_users, _transient, _store, _flush_interval
+    # 写入旧存储中尚未写入的变化
+    flush_session()
+    with _flush_lock, _lock:
+        _flush_interval = get_config('bot.session_flush_interval', 1)
+        if _store is not None:
+            _store.close()
+            _store = None
+        _session_cache = _get_store().load()
+        _auth_users = {uid for uid, sess in _session_cache.items() if sess.get(SESS_AUTH)}
+        metrics.set_gauge(metrics.AUTH_USERS, len(_auth_users))
+        _transient = TransientSessions(get_config('bot.transient_session.max_size', 1024),
+                                       get_config('bot.transient_session.ttl', 3600))
+    logger.debug("从存储恢复会话 %s", _session_cache)
 
 
 def get_session_for(uid: int) -> MappingProxyType:
@@ -32,9 +150,10 @@ def get_session_for(uid: int) -> MappingProxyType:
     :return:
     """
     uid = str(uid)
-    if uid not in _session_cache:
-        _session_cache[uid] = {}
-    return MappingProxyType(_session_cache[uid])
+    with _lock:
+        if uid in _session_cache:
+            return MappingProxyType(_session_cache[uid])
+        return MappingProxyType(_transient.get(uid))
 
 
 def get_session(uid: int, key: str, default_value=None) -> object:
@@ -46,38 +165,105 @@ def get_session(uid: int, key: str, default_value=None) -> object:
     :return:
     """
     uid = str(uid)
-    if uid not in _session_cache:
-        _session_cache[uid] = {}
-    if key not in _session_cache[uid]:
-        return default_value
-    return _session_cache[uid][key]
+    with _lock:
+        sess = _session_cache.get(uid)
+        if sess is None:
+            sess = _transient.peek(uid) or {}
+        return sess.get(key, default_value)
 
 
 def set_session(uid: int, key: str, value: object):
     """
-    设置用户会话值
+    设置用户会话值。未鉴权用户的会话不会保存
     :param uid:
     :param key:
     :param value:
     :return:
     """
     uid = str(uid)
-    if uid not in _session_cache:
-        _session_cache[uid] = {}
-    _session_cache[uid][key] = value
-    # 保存缓存
-    session_file = get_config('bot.session_file')
-    with open(session_file, 'w', encoding='utf-8') as f:
-        json.dump(_session_cache, f)
+    with _lock:
+        if uid in _session_cache:
+            _session_cache[uid][key] = value
+            changed = [(uid, key)]
+        elif key == SESS_AUTH and value:
+            # 鉴权后转为持久会话，沿用同一字典以保持已有视图有效
+            sess = _transient.pop(uid) or {}
+            sess[key] = value
+            _session_cache[uid] = sess
+            changed = [(uid, k) for k in sess]
+        else:
+            _transient.get(uid)[key] = value
+            return
+        if key == SESS_AUTH:
+            if value:
+                _auth_users.add(uid)
+            else:
+                _auth_users.discard(uid)
+            metrics.set_gauge(metrics.AUTH_USERS, len(_auth_users))
+        _dirty.update(changed)
+    # 保存缓存。写入失败等待重试期间不立即写入
+    if _flush_interval <= 0 and _retry_delay == 0:
+        flush_session()
+    else:
+        _schedule_flush()
 
 
-def all_user(auth=True) -> Iterable[int]:
+def _schedule_flush():
+    """
+    安排后台写入。已有待执行的写入时，本次变化将一并写入
+    :return:
+    """
+    global _flush_timer
+    with _lock:
+        if _flush_timer is not None:
+            return
+        delay = _retry_delay if _retry_delay > 0 else _flush_interval
+        _flush_timer = threading.Timer(delay, flush_session)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def flush_session():
+    """
+    立即将变化的会话写入存储。退出前应调用以写入剩余变化
+    :return:
+    """
+    global _dirty, _flush_timer, _retry_delay
+    with _flush_lock:
+        with _lock:
+            if _flush_timer is not None:
+                _flush_timer.cancel()
+                _flush_timer = None
+            if len(_dirty) == 0:
+                return
+            changed, _dirty = _dirty, set()
+            # 写入快照，避免写入期间阻塞会话读写。增量存储只需变化的用户
+            store = _get_store()
+            if store.full_snapshot:
+                uids = _session_cache.keys()
+            else:
+                uids = {uid for uid, __ in changed if uid in _session_cache}
+            sessions = {uid: dict(_session_cache[uid]) for uid in uids}
+        try:
+            store.save(sessions, changed)
+        except Exception as e:
+            with _lock:
+                _dirty |= changed
+                _retry_delay = min(max(_retry_delay * 2, _MIN_RETRY_DELAY), _MAX_RETRY_DELAY)
+            logger.error("保存会话失败，%d 秒后重试", _retry_delay, exc_info=e)
+            _schedule_flush()
+        else:
+            with _lock:
+                _retry_delay = 0
+
+
+def all_user(auth=True) -> List[int]:
     """
     获得所有用户
     :param auth:
     :return:
     """
-    if auth:
-        return map(lambda t: int(t[0]), filter(lambda t: SESS_AUTH in t[1] and t[1][SESS_AUTH], _session_cache.items()))
-    else:
-        return map(int, _session_cache.keys())
+    with _lock:
+        if auth:
+            return [int(uid) for uid in _auth_users]
+        return [int(uid) for uid in _session_cache] + [int(uid) for uid in _transient.keys()]
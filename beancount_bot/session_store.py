@@ -0,0 +1,121 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Tuple
+
+from beancount_bot.util import logger
+
+# 用户 -> 会话
+Sessions = Dict[str, dict]
+
+
+class SessionStore:
+    """
+    会话存储后端
+    """
+
+    # 保存时是否需要所有会话。为 False 时只需提供变化的用户
+    full_snapshot = True
+
+    def load(self) -> Sessions:
+        """
+        载入所有会话
+        :return:
+        """
+        raise NotImplementedError()
+
+    def save(self, sessions: Sessions, changed: Iterable[Tuple[str, str]]):
+        """
+        保存会话
+        :param sessions: 会话。full_snapshot 为 False 时只包含变化的用户
+        :param changed: 发生变化的 (用户, 键)。键已不在会话中表示删除
+        :return:
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """
+        关闭存储
+        :return:
+        """
+        pass
+
+
+class JsonSessionStore(SessionStore):
+    """
+    JSON 文件存储。每次保存原子地重写整个文件
+    """
+
+    def __init__(self, session_file: str):
+        """
+        :param session_file: 会话文件路径
+        """
+        self.session_file = session_file
+
+    def load(self) -> Sessions:
+        if not os.path.exists(self.session_file):
+            return {}
+        with open(self.session_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, sessions: Sessions, changed: Iterable[Tuple[str, str]]):
+        # 写入临时文件后替换，写入中断不会损坏原文件
+        tmp_file = self.session_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(sessions, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.session_file)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    SQLite 存储（WAL 模式）。每个会话值为一行，保存时只写入变化的值
+    """
+
+    full_snapshot = False
+
+    def __init__(self, db_file: str, migrate_from: str = None):
+        """
+        :param db_file: 数据库路径
+        :param migrate_from: JSON 会话文件。数据库新建时从中迁移会话
+        """
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            created = self._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='session'").fetchone() is None
+            self._conn.execute('CREATE TABLE IF NOT EXISTS session ('
+                               'uid TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (uid, key))')
+            if created and migrate_from is not None and os.path.exists(migrate_from):
+                sessions = JsonSessionStore(migrate_from).load()
+                self._conn.executemany('INSERT INTO session VALUES (?, ?, ?)',
+                                       [(uid, k, json.dumps(v)) for uid, sess in sessions.items() for k, v in sess.items()])
+                logger.info("已从 %s 迁移 %d 个用户的会话", migrate_from, len(sessions))
+
+    def load(self) -> Sessions:
+        sessions: Sessions = {}
+        with self._lock:
+            for uid, k, v in self._conn.execute('SELECT uid, key, value FROM session'):
+                sessions.setdefault(uid, {})[k] = json.loads(v)
+        return sessions
+
+    def save(self, sessions: Sessions, changed: Iterable[Tuple[str, str]]):
+        upsert, delete = [], []
+        for uid, k in changed:
+            sess = sessions.get(uid, {})
+            if k in sess:
+                upsert.append((uid, k, json.dumps(sess[k])))
+            else:
+                delete.append((uid, k))
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO session VALUES (?, ?, ?)', upsert)
+            self._conn.executemany('DELETE FROM session WHERE uid = ? AND key = ?', delete)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,14 +1,34 @@
+import collections
+import datetime
+import itertools
 import threading
 import time
-from typing import Dict
+import warnings
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import schedule
 from telebot import TeleBot
 
+from beancount_bot import metrics
+from beancount_bot.broadcast import get_broadcaster
 from beancount_bot.config import get_config, get_global, GLOBAL_TASK
+from beancount_bot.session import all_user
 from beancount_bot.util import logger, load_class
 
-_schedule_thread: threading.Thread = None
+_schedule_thread: Optional['ScheduleThread'] = None
+_task_executor: Optional['TaskExecutor'] = None
+_task_executor_lock = threading.Lock()
+
+# 任务运行状态
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+# 任务触发方式
+SOURCE_MANUAL = 'manual'
+SOURCE_SCHEDULE = 'schedule'
 
 
 class ScheduleTask:
@@ -33,10 +53,22 @@ class ScheduleTask:
     def trigger(self, bot: TeleBot):
         """
         触发任务。任务可通过两种方式触发：定时执行（register 中注册）、/task 任务名
+        耗时的任务应在后台执行并返回 Future，以免阻塞定时任务线程与 Bot
         :param bot: Bot 对象
         """
         pass
 
+    def broadcast(self, text: str, users: Iterable[int] = None, **kwargs) -> Future:
+        """
+        向用户广播消息。消息加入共享的发送队列后立即返回，发送受全局限流
+        :param text: 消息内容
+        :param users: 接收用户。默认为所有已鉴权用户
+        :return: 全部发送完成后完成的 Future，结果为 BroadcastReport
+        """
+        if users is None:
+            users = all_user()
+        return get_broadcaster().broadcast(users, text, **kwargs)
+
 
 def load_task() -> Dict[str, ScheduleTask]:
     """
@@ -53,10 +85,14 @@ def load_task() -> Dict[str, ScheduleTask]:
 
         logger.info('注册定时任务：%s', name)
         task: ScheduleTask = clazz(**args)
-        task.register(lambda capture_task=task: capture_task.trigger(bot))
+        task.register(lambda capture_name=name, capture_task=task:
+                      get_task_executor().submit(capture_name, capture_task, bot, SOURCE_SCHEDULE))
         task.config = conf
 
         ret[name] = task
+    # 唤醒定时任务线程，按新的任务重新计时
+    if _schedule_thread is not None:
+        _schedule_thread.wakeup()
     return ret
 
 
@@ -68,25 +104,232 @@ def get_task() -> Dict[str, ScheduleTask]:
     return get_global(GLOBAL_TASK, load_task)
 
 
-def start_schedule_thread(interval=5) -> threading.Thread:
+class TaskJob:
     """
-    运行定时任务
-    :param interval:
+    任务运行记录
+    """
+
+    def __init__(self, job_id: int, name: str, source: str):
+        """
+        :param job_id: 运行编号
+        :param name: 任务名
+        :param source: 触发方式
+        """
+        self.id = job_id
+        self.name = name
+        self.source = source
+        self.status = JOB_PENDING
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.error: Optional[BaseException] = None
+
+    @property
+    def elapsed(self) -> float:
+        """
+        已运行时间。运行结束后为总用时
+        :return:
+        """
+        if self.started is None:
+            return 0.0
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+
+class TaskExecutor:
+    """
+    任务执行器。在后台执行任务，并记录正在运行与最近完成的任务。同一任务运行期间不会重复触发
+    """
+
+    def __init__(self, max_workers: int = 2, history: int = 10):
+        """
+        :param max_workers: 同时执行的最大任务数
+        :param history: 保留的已完成任务记录数
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task')
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._active: Dict[str, TaskJob] = {}
+        self._history = collections.deque(maxlen=history)
+
+    def submit(self, name: str, task: ScheduleTask, bot: TeleBot, source: str = SOURCE_MANUAL,
+               callback: Callable[[TaskJob], None] = None) -> Tuple[TaskJob, bool]:
+        """
+        触发任务，立即返回
+        :param name: 任务名
+        :param task: 任务
+        :param bot: Bot 对象
+        :param source: 触发方式
+        :param callback: 任务结束后以运行记录调用。任务已在运行时不会调用
+        :return: 运行记录，是否新触发。任务已在运行时返回正在运行的记录
+        """
+        with self._lock:
+            job = self._active.get(name)
+            if job is not None:
+                return job, False
+            job = TaskJob(next(self._ids), name, source)
+            self._active[name] = job
+        self._executor.submit(self._run, job, task, bot, callback)
+        return job, True
+
+    def _run(self, job: TaskJob, task: ScheduleTask, bot: TeleBot, callback: Callable[[TaskJob], None]):
+        with self._lock:
+            job.status = JOB_RUNNING
+            job.started = time.time()
+        logger.info('执行任务：%s（#%d）', job.name, job.id)
+        try:
+            ret = task.trigger(bot)
+        except Exception as e:
+            self._finish(job, e, callback)
+            return
+        # 任务返回 Future 时，以 Future 完成作为任务结束
+        if isinstance(ret, Future):
+            ret.add_done_callback(lambda future: self._finish(job, _future_error(future), callback))
+        else:
+            self._finish(job, None, callback)
+
+    def _finish(self, job: TaskJob, error: Optional[BaseException], callback: Callable[[TaskJob], None]):
+        # 设置结果后在同一锁内移入历史，jobs 不会看到状态不一致的记录
+        with self._lock:
+            job.finished = time.time()
+            job.error = error
+            job.status = JOB_FAILED if error is not None else JOB_SUCCEEDED
+            if self._active.get(job.name) is job:
+                del self._active[job.name]
+            self._history.append(job)
+        if error is not None:
+            logger.error('任务执行失败：%s（#%d）', job.name, job.id, exc_info=error)
+        else:
+            logger.info('任务执行完成：%s（#%d），用时 %.2fs', job.name, job.id, job.elapsed)
+        metrics.set_gauge(metrics.TASK_SECONDS, job.elapsed)
+        if callback is not None:
+            try:
+                callback(job)
+            except Exception as e:
+                logger.error('任务回调出错', exc_info=e)
+
+    def jobs(self) -> Tuple[List[TaskJob], List[TaskJob]]:
+        """
+        获得任务运行记录
+        :return: 正在运行的任务，最近完成的任务（新的在前）
+        """
+        with self._lock:
+            return sorted(self._active.values(), key=lambda j: j.id), list(reversed(self._history))
+
+    def shutdown(self, wait: bool = True):
+        """
+        停止执行器
+        :param wait: 是否等待已触发的任务开始执行
+        :return:
+        """
+        self._executor.shutdown(wait=wait)
+
+
+def _future_error(future: Future) -> Optional[BaseException]:
+    """
+    获得已完成 Future 的异常。被取消的 Future 视为以 CancelledError 结束
+    :param future:
+    :return: 正常完成时返回 None
+    """
+    if future.cancelled():
+        return CancelledError()
+    return future.exception()
+
+
+def get_task_executor() -> TaskExecutor:
+    """
+    获得共享的任务执行器
     :return:
     """
+    global _task_executor
+    with _task_executor_lock:
+        if _task_executor is None:
+            _task_executor = TaskExecutor(max_workers=get_config('task.max_workers', 2),
+                                          history=get_config('task.history', 10))
+        return _task_executor
+
+
+class ScheduleThread(threading.Thread):
+    """
+    定时任务线程。休眠至最近的任务到期；每次唤醒时按调度器中的任务重新计算，任务变化时可通过 wakeup 提前唤醒
+    """
+
+    def __init__(self, scheduler: schedule.Scheduler = None, max_wait: float = 60):
+        """
+        :param scheduler: 任务所在的 schedule 调度器。默认为 schedule 模块的全局调度器
+        :param max_wait: 单次休眠的最长时间（秒）。到时重新计算等待时间，以应对系统时间跳变（如校时、休眠恢复）
+        """
+        super().__init__(name='ScheduleThread', daemon=True)
+        self._scheduler = scheduler if scheduler is not None else schedule.default_scheduler
+        self._max_wait = max_wait
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def wakeup(self):
+        """
+        任务发生变化，重新计算下次运行时间
+        :return:
+        """
+        with self._cond:
+            self._cond.notify()
 
-    class ScheduleThread(threading.Thread):
-        @classmethod
-        def run(cls):
-            while True:
-                try:
-                    schedule.run_pending()
-                except Exception as e:
-                    logger.warn('定时任务出错：%s', e)
-                time.sleep(interval)
+    def stop(self):
+        """
+        停止线程。正在执行的任务将执行完毕
+        :return:
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
 
+    def run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                # 每次唤醒都从调度器读取任务，未调用 wakeup 而增删的任务最迟在 max_wait 后生效
+                jobs = list(self._scheduler.jobs)
+                if len(jobs) == 0:
+                    self._cond.wait(self._max_wait)
+                    continue
+                job = min(jobs, key=lambda j: j.next_run)
+                delay = (job.next_run - datetime.datetime.now()).total_seconds()
+                if delay > 0:
+                    self._cond.wait(min(delay, self._max_wait))
+                    continue
+            self._run_job(job)
+
+    def _run_job(self, job: schedule.Job):
+        """
+        执行到期任务，并记录实际执行时间与计划时间之差
+        :param job:
+        :return:
+        """
+        if job not in self._scheduler.jobs:
+            return
+        lateness = (datetime.datetime.now() - job.next_run).total_seconds()
+        metrics.set_gauge(metrics.SCHEDULE_LATENESS, lateness)
+        metrics.inc(metrics.SCHEDULE_RUNS)
+        logger.debug('执行定时任务：%s，延迟 %.3fs', job, lateness)
+        try:
+            ret = job.run()
+            if isinstance(ret, schedule.CancelJob) or ret is schedule.CancelJob:
+                self._scheduler.cancel_job(job)
+        except Exception as e:
+            logger.warning('定时任务出错：%s', e)
+            # 任务出错时 schedule 不会计算下次运行时间，此处补上以免反复执行
+            if job.next_run <= datetime.datetime.now():
+                job._schedule_next_run()
+
+
+def start_schedule_thread(interval: float = None) -> ScheduleThread:
+    """
+    运行定时任务
+    :param interval: 已弃用。定时任务线程在任务到期时唤醒，不再轮询
+    :return:
+    """
+    if interval is not None:
+        warnings.warn('start_schedule_thread 的 interval 参数已弃用，将被忽略', DeprecationWarning, stacklevel=2)
     global _schedule_thread
     _schedule_thread = ScheduleThread()
-    _schedule_thread.setDaemon(True)
     _schedule_thread.start()
     return _schedule_thread
@@ -1,66 +1,224 @@
-import copy
 import datetime
+import glob
 import os
+import threading
+import textwrap
 import time
 import uuid
-from typing import List, Tuple, Union
+from concurrent.futures import Future
+from typing import Dict, List, Union
 
 from beancount.core.data import Transaction
 from beancount.parser import printer, parser
 
 from beancount_bot.config import get_global, GLOBAL_MANAGER, get_config
-from beancount_bot.dispatcher import Dispatcher
+from beancount_bot.dispatcher import Dispatcher, DispatcherRouter, ParseContext
 from beancount_bot.i18n import _
-from beancount_bot.util import load_class, stringify_errors, logger
+from beancount_bot.ledger_index import LedgerIndex, ShardRegistry, splice_file, read_range, tombstone_file, \
+    compact_file, find_comment_wrapped, INDEX_SUFFIX, INDEX_TMP_SUFFIX, COMPACT_SUFFIX
+from beancount_bot.ledger_writer import LedgerWriter, PendingEntry, FSYNC_NONE, FSYNC_BATCH, FSYNC_ENTRY, \
+    FSYNC_POLICIES
+from beancount_bot.util import load_class, stringify_errors, logger, indent
 
 META_UUID = 'tgbot_uuid'
 META_TIME = 'tgbot_time'
+# 控制元数据行的前缀
+_CONTROL_META_PREFIXES = tuple(f'{key}:' for key in (META_UUID, META_TIME))
+
+# 撤回模式
+WITHDRAW_SPLICE = 'splice'
+WITHDRAW_TOMBSTONE = 'tombstone'
+WITHDRAW_MODES = [WITHDRAW_SPLICE, WITHDRAW_TOMBSTONE]
+
+# 账本文件名中可用的时间参数
+BEAN_FILE_PARAMS = {
+    'year': '%Y',
+    'month': '%m',
+    'date': '%d',
+}
 
 Uuid = str
 
+# 账本文件锁。同一账本的写入、撤回与压缩互斥，即使来自不同的管理对象（如重载配置前后）
+_file_locks: Dict[str, threading.RLock] = {}
+_file_locks_lock = threading.Lock()
+
 
 class NotMatchException(Exception):
     pass
 
 
+class CreateResult(tuple):
+    """
+    交易创建结果。可解包为 (uuid, 交易)，text 为交易写入账本的文本，reply_text 为回复用户的文本
+    """
+
+    def __new__(cls, tx_uuid: Uuid, tx: Union[Transaction, str], text: str):
+        result = super().__new__(cls, (tx_uuid, tx))
+        result.text = text
+        return result
+
+    @property
+    def reply_text(self) -> str:
+        """
+        回复用户的交易文本，不含控制元数据
+        :return:
+        """
+        if isinstance(self[1], str):
+            return self.text
+        return ''.join(line for line in self.text.splitlines(keepends=True)
+                       if not line.lstrip().startswith(_CONTROL_META_PREFIXES))
+
+
 class TransactionManager:
     """
     交易信息管理
     """
 
-    def __init__(self, dispatchers: List[Dispatcher], bean_file: str):
+    def __init__(self, dispatchers: List[Dispatcher], bean_file: str, fsync: str = FSYNC_NONE, writer: dict = None,
+                 withdraw_mode: str = WITHDRAW_SPLICE, compact_interval: float = 3600,
+                 compact_threshold: int = 1024 * 1024):
+        """
+        :param dispatchers: 交易语句处理器
+        :param bean_file: 账本文件。可以使用：{year}、{month}、{date}
+        :param fsync: 写入同步策略：none、batch（每次写入后同步）、entry（每条语句后同步）
+        :param writer: 写入线程参数，参考 LedgerWriter。为 None 则在调用线程中直接写入
+        :param withdraw_mode: 撤回模式：splice（从账本中删除）、tombstone（原地标记撤回，之后在后台压缩账本）
+        :param compact_interval: tombstone 模式下，撤回后多久压缩账本（秒）
+        :param compact_threshold: tombstone 模式下，已撤回内容超过此字节数时立即压缩账本
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(_("未知的同步策略：{fsync}").format(fsync=fsync))
+        if withdraw_mode not in WITHDRAW_MODES:
+            raise ValueError(_("未知的撤回模式：{mode}").format(mode=withdraw_mode))
         self.dispatchers = dispatchers
+        self._router = DispatcherRouter(dispatchers)
         self.__bean_file = bean_file
+        self._bean_file_cache = ('', 0.0)
+        self._fsync = fsync
+        self._lock = threading.RLock()
+        self._writer = LedgerWriter(self._write_entries, **writer) if writer is not None else None
+        self._pending: Dict[Uuid, Future] = {}
+        self._withdraw_mode = withdraw_mode
+        self._compact_interval = compact_interval
+        self._compact_threshold = compact_threshold
+        self._compact_timer: threading.Timer = None
+        # 载入所有分片的索引
+        self._registry = ShardRegistry()
+        self._indexes: Dict[str, LedgerIndex] = self._registry.rebuild(self._shard_files())
+        if any(index.dead_bytes > 0 for index in self._indexes.values()):
+            self._schedule_compact()
 
-    def create(self, tx: Union[Transaction, str], add_tags=None) -> Tuple[Uuid, Union[Transaction, str]]:
+    def create(self, tx: Union[Transaction, str], add_tags=None, wait=True) -> CreateResult:
         """
-        创建交易
+        创建交易。交易只格式化一次，写入账本与回复使用同一文本
         :param tx:
         :param add_tags: 给交易添加的标签
-        :return:
+        :param wait: 是否等待交易写入账本。若不等待，可通过 wait_durable 等待
+        :return: (uuid, 交易)，附带交易文本
+        """
+        return self.create_many([tx], add_tags, wait)[0]
+
+    def create_many(self, txs: List[Union[Transaction, str]], add_tags=None, wait=True) -> List[CreateResult]:
+        """
+        创建多条交易，在一次追加中写入账本
+        :param txs:
+        :param add_tags: 给交易添加的标签
+        :param wait: 是否等待交易写入账本。若不等待，可通过 wait_durable 等待
+        :return: 每条交易的创建结果
         """
         if add_tags is None:
             add_tags = []
-        tx_uuid = Uuid(uuid.uuid4())
-        if isinstance(tx, str):
-            # 保存至账本
-            with open(self.bean_file, 'a+', encoding='utf-8') as f:
-                f.write(f"; TGBOT_START {tx_uuid}\n{tx}\n; TGBOT_END {tx_uuid}\n")
-            return tx_uuid, tx
-        elif isinstance(tx, Transaction):
-            # 添加控制元数据
-            tx = copy.deepcopy(tx)
-            tx.meta[META_UUID] = tx_uuid
-            tx.meta[META_TIME] = str(datetime.datetime.now())
-            # 添加标签
-            tx = tx._replace(tags=set(tx.tags).union(add_tags))
-            # 保存至账本
-            logger.debug("创建交易：%s", tx)
-            with open(self.bean_file, 'a+', encoding='utf-8') as f:
-                printer.print_entry(tx, file=f)
-            return tx_uuid, tx
-        else:
-            raise ValueError()
+        results = []
+        entries: List[PendingEntry] = []
+        for tx in txs:
+            tx_uuid = Uuid(uuid.uuid4())
+            if isinstance(tx, str):
+                results.append(CreateResult(tx_uuid, tx, tx))
+                entries.append((tx_uuid, f"; TGBOT_START {tx_uuid}\n{tx}\n; TGBOT_END {tx_uuid}\n", ''))
+            elif isinstance(tx, Transaction):
+                # 添加控制元数据、标签。只替换交易头，不修改传入的交易
+                meta = dict(tx.meta)
+                meta[META_UUID] = tx_uuid
+                meta[META_TIME] = str(datetime.datetime.now())
+                tx = tx._replace(meta=meta, tags=set(tx.tags).union(add_tags))
+                logger.debug("创建交易：%s", tx)
+                text = printer.format_entry(tx)
+                results.append(CreateResult(tx_uuid, tx, text))
+                entries.append((tx_uuid, text, '\n'))
+            else:
+                raise ValueError()
+        # 保存至账本
+        self._append(entries, wait=wait)
+        return results
+
+    def _index_for(self, bean_file: str) -> LedgerIndex:
+        """
+        获得账本文件对应的索引
+        :param bean_file:
+        :return:
+        """
+        if bean_file not in self._indexes:
+            self._indexes[bean_file] = LedgerIndex(bean_file)
+        return self._indexes[bean_file]
+
+    def _append(self, entries: List[PendingEntry], wait=True):
+        """
+        向账本追加语句
+        :param entries: 待写入语句
+        :param wait: 是否等待写入完成
+        :return:
+        """
+        bean_file = self.bean_file
+        if self._writer is None:
+            self._write_entries(bean_file, entries)
+            return
+        future = self._writer.submit(bean_file, entries)
+        if wait:
+            future.result()
+            return
+        for tx_uuid, __, __ in entries:
+            self._pending[tx_uuid] = future
+            future.add_done_callback(lambda __, key=tx_uuid: self._pending.pop(key, None))
+
+    def _write_entries(self, bean_file: str, entries: List[PendingEntry]):
+        """
+        将语句一次性追加至账本，并记录至索引
+        :param bean_file:
+        :param entries:
+        :return:
+        """
+        with self._lock, _file_lock(bean_file):
+            index = self._index_for(bean_file)
+            index.refresh()
+            ranges = []
+            with open(bean_file, 'ab') as f:
+                pos = f.tell()
+                for tx_uuid, entry, suffix in entries:
+                    data, suffix_data = entry.encode('utf-8'), suffix.encode('utf-8')
+                    f.write(data + suffix_data)
+                    ranges.append((tx_uuid, (pos, pos + len(data))))
+                    pos += len(data) + len(suffix_data)
+                    if self._fsync == FSYNC_ENTRY:
+                        f.flush()
+                        os.fsync(f.fileno())
+                if self._fsync == FSYNC_BATCH:
+                    f.flush()
+                    os.fsync(f.fileno())
+            index.extend(ranges)
+            for tx_uuid, __ in ranges:
+                self._registry.register(tx_uuid, bean_file)
+
+    def wait_durable(self, tx_uuid: Uuid, timeout: float = None):
+        """
+        等待交易写入账本。交易已写入时立刻返回
+        :param tx_uuid:
+        :param timeout:
+        :return:
+        """
+        future = self._pending.get(tx_uuid)
+        if future is not None:
+            future.result(timeout)
 
     def remove(self, tx_uuid: Uuid) -> Union[Transaction, str]:
         """
@@ -68,7 +226,91 @@ class TransactionManager:
         :param tx_uuid:
         :return:
         """
-        entries, errors, __ = parser.parse_file(self.bean_file)
+        self.wait_durable(tx_uuid)
+        with self._lock:
+            # 查找交易所在分片，未知则视为当前账本
+            bean_file = self._registry.lookup(tx_uuid) or self.bean_file
+            with _file_lock(bean_file):
+                index = self._index_for(bean_file)
+                index.refresh()
+                rng = index.lookup(tx_uuid)
+                if rng is not None and str(tx_uuid).encode('utf-8') in read_range(bean_file, *rng):
+                    removed = None
+                    if self._withdraw_mode == WITHDRAW_TOMBSTONE:
+                        # 原地标记撤回
+                        removed = tombstone_file(bean_file, *rng, tx_uuid)
+                        if removed is not None:
+                            index.remove(tx_uuid, 0)
+                            self._schedule_compact(index)
+                    if removed is None:
+                        # 通过索引直接删除对应区间
+                        removed = splice_file(bean_file, *rng)
+                        index.remove(tx_uuid, rng[1] - rng[0])
+                    self._registry.unregister(tx_uuid)
+                    return _restore_removed(removed.decode('utf-8'))
+                # 索引中不存在，解析账本查找
+                return self._remove_by_parse(bean_file, tx_uuid)
+
+    def _schedule_compact(self, index: LedgerIndex = None):
+        """
+        安排压缩账本。已撤回内容超过阈值时立即在后台压缩，否则在 compact_interval 后压缩
+        :param index: 刚发生撤回的账本索引
+        :return:
+        """
+        with self._lock:
+            delay = self._compact_interval
+            if index is not None and index.dead_bytes >= self._compact_threshold:
+                delay = 0
+            elif self._compact_timer is not None:
+                return
+            if self._compact_timer is not None:
+                self._compact_timer.cancel()
+            self._compact_timer = threading.Timer(delay, self.compact)
+            self._compact_timer.daemon = True
+            self._compact_timer.start()
+
+    def compact(self):
+        """
+        压缩所有存在撤回标记的账本
+        :return:
+        """
+        with self._lock:
+            if self._compact_timer is not None:
+                self._compact_timer.cancel()
+                self._compact_timer = None
+            for bean_file, index in self._indexes.items():
+                with _file_lock(bean_file):
+                    index.refresh()
+                    if index.dead_bytes == 0:
+                        continue
+                    logger.info('压缩账本：%s', bean_file)
+                    try:
+                        compact_file(bean_file)
+                    except OSError as e:
+                        logger.error('压缩账本失败：%s', bean_file, exc_info=e)
+                        continue
+                    index.rebuild()
+
+    def close(self):
+        """
+        停止后台工作：取消压缩定时器，写入排队中的交易后停止写入线程。重载配置替换管理对象时调用
+        :return:
+        """
+        with self._lock:
+            if self._compact_timer is not None:
+                self._compact_timer.cancel()
+                self._compact_timer = None
+        if self._writer is not None:
+            self._writer.close()
+
+    def _remove_by_parse(self, bean_file: str, tx_uuid: Uuid) -> Union[Transaction, str]:
+        """
+        解析整个账本以删除交易
+        :param bean_file:
+        :param tx_uuid:
+        :return:
+        """
+        entries, errors, __ = parser.parse_file(bean_file)
         # 筛选交易
         to_delete = next(
             filter(lambda tx: tx.meta[META_UUID] == tx_uuid if META_UUID in tx.meta else False, entries),
@@ -77,7 +319,7 @@ class TransactionManager:
         if to_delete is None:
             # 不存在此交易，可能是非交易语句
             try:
-                return self._remove_comment_wrapped(tx_uuid)
+                return self._remove_comment_wrapped(bean_file, tx_uuid)
             except Exception as e:
                 # 如果账本文件解析错误，报解析错误
                 if len(errors) > 0:
@@ -91,56 +333,85 @@ class TransactionManager:
         for posting in to_delete.postings:
             max_line = max(max_line, posting.meta['lineno'])
         # 删除
-        with open(self.bean_file, 'r', encoding='utf-8') as f:
+        with open(bean_file, 'r', encoding='utf-8') as f:
             lines = f.readlines()
-        with open(self.bean_file, 'w', encoding='utf-8') as f:
+        with open(bean_file, 'w', encoding='utf-8') as f:
             f.write(''.join(lines[:min_line - 1] + lines[max_line:]))
         return to_delete
 
-    def _remove_comment_wrapped(self, tx_uuid: Uuid) -> str:
+    def _remove_comment_wrapped(self, bean_file: str, tx_uuid: Uuid) -> str:
         """
         使用注释包裹
+        :param bean_file:
         :param tx_uuid:
         :return:
         """
-        with open(self.bean_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        # 筛选列
-        min_line = -1
-        for i in range(len(lines)):
-            if f'TGBOT_START {tx_uuid}' in lines[i]:
-                min_line = i
-                break
-        max_line = -1
-        for i in range(len(lines)):
-            if f'TGBOT_END {tx_uuid}' in lines[i]:
-                max_line = i
-                break
-        if min_line == -1 or max_line == -1:
+        found = find_comment_wrapped(bean_file, tx_uuid)
+        if found is None:
             raise ValueError(_("交易不存在！"))
         # 删除
-        with open(self.bean_file, 'w', encoding='utf-8') as f:
-            f.write(''.join(lines[:min_line] + lines[max_line + 1:]))
-        return ''.join(lines[min_line + 1:max_line])[:-1]
+        block_start, inner_start, inner_end, block_end = found
+        removed = splice_file(bean_file, block_start, block_end)
+        return removed[inner_start - block_start:inner_end - block_start].decode('utf-8')[:-1]
 
-    def create_from_str(self, tx_str, **kwargs) -> Union[Tuple[Uuid, Transaction], Tuple[None, str]]:
+    def create_from_str(self, tx_str, **kwargs) -> CreateResult:
         """
         从交易语法创建交易
         :param tx_str:
+        :return: 同 create
+        """
+        return self.create(self._parse_transaction(tx_str), **kwargs)
+
+    def create_batch(self, blocks: List[str], **kwargs) -> List[CreateResult]:
+        """
+        批量创建交易。每条语句分别交由处理器处理，生成的语法统一解析校验后在一次追加中写入账本
+        :param blocks: 切分后的语句，见 split_blocks
+        :return: 同 create_many
+        """
+        return self.create_many(self._parse_batch(blocks), **kwargs)
+
+    def _parse_batch(self, blocks: List[str]) -> List[Union[Transaction, str]]:
+        """
+        解析多条语句。任一语句有误则抛出 ValueError
+        :param blocks:
         :return:
         """
-        tx = self._parse_transaction(tx_str)
-        tx_uuid, _ = self.create(tx, **kwargs)
-        return tx_uuid, tx
+        results: List[Union[Transaction, str]] = []
+        for i, block in enumerate(blocks, 1):
+            try:
+                results.append(self._parse_transaction(block, raw=True))
+            except ValueError as e:
+                raise ValueError(_("第 {n} 条语句：{error}").format(n=i, error=e.args[0])) from e
+        # 未解析的语法逐条解析，避免 pushtag、option 等指令影响其他语句
+        for i, result in enumerate(results):
+            if not isinstance(result, str):
+                continue
+            entries, errors, __ = parser.parse_string(textwrap.dedent(result))
+            if len(errors) > 0:
+                raise ValueError(_("第 {n} 条语句解析结果存在语法错误！\n解析结果：\n{result}\n错误:\n{desc}")
+                                 .format(n=i + 1, result=indent(result), desc=indent(stringify_errors(errors))))
+            if len(entries) > 1:
+                raise ValueError(_("第 {n} 条语句：不支持解析结果为多条语句").format(n=i + 1))
+            # 注释等非交易语句保留原字符串
+            if len(entries) == 1 and isinstance(entries[0], Transaction):
+                results[i] = entries[0]
+        return results
 
-    def _parse_transaction(self, tx_str) -> Transaction:
-        for dispatcher in self.dispatchers:
-            if not dispatcher.quick_check(tx_str):
+    def _parse_transaction(self, tx_str: str, raw=False) -> Union[Transaction, str]:
+        """
+        将输入交由处理器处理
+        :param tx_str:
+        :param raw: 是否返回未经解析的语法（见 Dispatcher.process_raw_ctx）
+        :return:
+        """
+        # 各处理器共享同一解析上下文
+        ctx = ParseContext(tx_str)
+        for dispatcher in self._router.candidates(ctx):
+            if not dispatcher.quick_check_ctx(ctx):
                 continue
             # 尝试解析
             try:
-                tx = dispatcher.process(tx_str)
-                return tx
+                return dispatcher.process_raw_ctx(ctx) if raw else dispatcher.process_ctx(ctx)
             except NotMatchException:
                 # 不能通过该解析器解析
                 continue
@@ -150,14 +421,17 @@ class TransactionManager:
 
     @property
     def bean_file(self) -> str:
-        params = {
-            'year': time.strftime("%Y", time.localtime()),
-            'month': time.strftime("%m", time.localtime()),
-            'date': time.strftime("%d", time.localtime()),
-        }
+        """
+        当前时间对应的账本文件。结果在下一个日、月或年边界前保持缓存
+        :return:
+        """
+        bean_file, expire_at = self._bean_file_cache
+        if time.time() < expire_at:
+            return bean_file
+        now = datetime.datetime.now()
         bean_file = self.__bean_file
-        for k, v in params.items():
-            bean_file = bean_file.replace(f'{{{k}}}', v)
+        for k, fmt in BEAN_FILE_PARAMS.items():
+            bean_file = bean_file.replace(f'{{{k}}}', now.strftime(fmt))
         # 创建父文件夹
         try:
             path = os.path.dirname(os.path.realpath(bean_file))
@@ -165,8 +439,80 @@ class TransactionManager:
         except OSError as e:
             logger.error("无法创建账本文件夹", exc_info=e)
             raise ValueError(_("无法创建账本文件夹！"))
+        self._bean_file_cache = (bean_file, _next_boundary(self.__bean_file, now))
         return bean_file
 
+    def _shard_files(self) -> List[str]:
+        """
+        获得所有已存在的账本分片。排除 Bot 自身的索引与临时文件
+        :return:
+        """
+        pattern = glob.escape(self.__bean_file)
+        for k in BEAN_FILE_PARAMS:
+            pattern = pattern.replace(f'{{{k}}}', '*')
+        aux_suffixes = (INDEX_SUFFIX, INDEX_TMP_SUFFIX, COMPACT_SUFFIX)
+        return [path for path in glob.glob(pattern) if os.path.isfile(path) and not path.endswith(aux_suffixes)]
+
+
+def _file_lock(bean_file: str) -> threading.RLock:
+    """
+    获得账本文件的锁
+    :param bean_file:
+    :return:
+    """
+    key = os.path.realpath(bean_file)
+    with _file_locks_lock:
+        return _file_locks.setdefault(key, threading.RLock())
+
+
+def _next_boundary(bean_file: str, now: datetime.datetime) -> float:
+    """
+    计算账本文件名下一次变化的时间
+    :param bean_file: 账本文件名模板
+    :param now:
+    :return: 时间戳。文件名不随时间变化时为 inf
+    """
+    if '{date}' in bean_file:
+        boundary = now.date() + datetime.timedelta(days=1)
+    elif '{month}' in bean_file:
+        boundary = datetime.date(now.year + now.month // 12, now.month % 12 + 1, 1)
+    elif '{year}' in bean_file:
+        boundary = datetime.date(now.year + 1, 1, 1)
+    else:
+        return float('inf')
+    return datetime.datetime.combine(boundary, datetime.time.min).timestamp()
+
+
+def _restore_removed(text: str) -> Union[Transaction, str]:
+    """
+    从被删除的账本内容还原交易
+    :param text:
+    :return:
+    """
+    if text.startswith('; TGBOT_START'):
+        # 去除首尾注释行及语句后换行
+        lines = text.splitlines(keepends=True)
+        return ''.join(lines[1:-1])[:-1]
+    entries, __, __ = parser.parse_string(text)
+    return entries[0] if len(entries) > 0 else text
+
+
+def split_blocks(text: str) -> List[str]:
+    """
+    切分批量消息。每个非缩进行开始一条语句，缩进行属于上一条语句，忽略空行
+    :param text:
+    :return:
+    """
+    blocks: List[str] = []
+    for line in text.split('\n'):
+        if line.strip() == '':
+            continue
+        if line[0] in ' \t' and len(blocks) > 0:
+            blocks[-1] += '\n' + line
+        else:
+            blocks.append(line)
+    return blocks
+
 
 def stringfy(tx: Union[Transaction, str]) -> str:
     """
@@ -193,7 +539,15 @@ def get_manager() -> TransactionManager:
             dispatchers.append(clazz(**conf['args']))
         # 获得 Bean 文件位置
         bean_file: str = get_config('transaction.beancount_file')
+        # 写入设置
+        fsync: str = get_config('transaction.fsync', FSYNC_NONE)
+        writer: dict = get_config('transaction.writer')
+        # 撤回设置
+        withdraw_mode: str = get_config('transaction.withdraw_mode', WITHDRAW_SPLICE)
+        compact_interval: float = get_config('transaction.compaction.interval', 3600)
+        compact_threshold: int = get_config('transaction.compaction.threshold', 1024 * 1024)
         # 创建对象
-        return TransactionManager(dispatchers, bean_file)
+        return TransactionManager(dispatchers, bean_file, fsync=fsync, writer=writer, withdraw_mode=withdraw_mode,
+                                  compact_interval=compact_interval, compact_threshold=compact_threshold)
 
     return get_global(GLOBAL_MANAGER, create_manager)
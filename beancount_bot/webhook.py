@@ -0,0 +1,152 @@
+import queue
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Tuple
+
+from telebot import TeleBot
+from telebot.types import Update
+
+from beancount_bot.bot import bot, setup_bot
+from beancount_bot.config import get_config
+from beancount_bot.util import logger
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    每个请求一个线程的 HTTP 服务器（http.server.ThreadingHTTPServer 需要 Python 3.7）
+    """
+    daemon_threads = True
+
+
+class WebhookServer:
+    """
+    Webhook 接收服务器。收到的更新放入有界队列后立即返回 200，由处理线程交给 bot.process_new_updates
+    """
+
+    def __init__(self, telebot: TeleBot, listen: str = '127.0.0.1', port: int = 8443, path: str = '/webhook',
+                 queue_size: int = 1024, max_batch: int = 100, max_body_size: int = 1024 * 1024):
+        """
+        :param telebot: 处理更新的 Bot
+        :param listen: 监听地址
+        :param port: 监听端口。为 0 则随机选择
+        :param path: 接收更新的路径。建议使用难以猜测的路径
+        :param queue_size: 队列长度。队列满时返回 503，由 Telegram 稍后重发
+        :param max_batch: 单次交给 Bot 的最大更新数
+        :param max_body_size: 请求体的最大字节数，超过则返回 413
+        """
+        self.bot = telebot
+        self.path = path
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._max_batch = max_batch
+        self._max_body_size = max_body_size
+        self._httpd = _ThreadingHTTPServer((listen, port), self._make_handler())
+        self._worker = threading.Thread(target=self._process, name='WebhookWorker', daemon=True)
+
+    @property
+    def server_address(self) -> Tuple[str, int]:
+        return self._httpd.server_address[:2]
+
+    def _make_handler(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_error(404)
+                    return
+                try:
+                    length = int(self.headers['Content-Length'])
+                except (TypeError, ValueError):
+                    self.send_error(400)
+                    return
+                if length < 0:
+                    self.send_error(400)
+                    return
+                if length > server._max_body_size:
+                    self.send_error(413)
+                    return
+                body = self.rfile.read(length)
+                try:
+                    update = Update.de_json(body.decode('utf-8'))
+                except Exception as e:
+                    logger.warning('无法解析 Webhook 更新', exc_info=e)
+                    self.send_error(400)
+                    return
+                try:
+                    server._queue.put_nowait(update)
+                except queue.Full:
+                    self.send_error(503)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug('Webhook %s - %s', self.address_string(), format % args)
+
+        return WebhookHandler
+
+    def _process(self):
+        while True:
+            update = self._queue.get()
+            if update is None:
+                return
+            # 合并已到达的更新
+            updates = [update]
+            while len(updates) < self._max_batch:
+                try:
+                    update = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if update is None:
+                    self._queue.put(None)
+                    break
+                updates.append(update)
+            try:
+                self.bot.process_new_updates(updates)
+            except Exception as e:
+                logger.error('处理更新失败', exc_info=e)
+
+    def serve_forever(self):
+        """
+        启动处理线程，并在当前线程中接收更新，直到 shutdown
+        :return:
+        """
+        self._worker.start()
+        self._httpd.serve_forever()
+
+    def shutdown(self):
+        """
+        停止接收更新，处理完已接收的更新后退出
+        :return:
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._queue.put(None)
+        if self._worker.is_alive():
+            self._worker.join()
+
+
+def serving_webhook():
+    """
+    以 Webhook 模式启动 Bot
+    :return:
+    """
+    setup_bot()
+    server = WebhookServer(bot,
+                           listen=get_config('serving.webhook.listen', '127.0.0.1'),
+                           port=get_config('serving.webhook.port', 8443),
+                           path=get_config('serving.webhook.path', '/webhook'),
+                           queue_size=get_config('serving.webhook.queue_size', 1024),
+                           max_body_size=get_config('serving.webhook.max_body_size', 1024 * 1024))
+    # 设置了公开地址时，向 Telegram 注册 Webhook
+    url = get_config('serving.webhook.url')
+    if url is not None:
+        bot.remove_webhook()
+        bot.set_webhook(url=url)
+    logger.info("Webhook 监听于 %s:%d%s", *server.server_address, server.path)
+    try:
+        server.serve_forever()
+    finally:
+        server.shutdown()
@@ -0,0 +1,61 @@
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Hashable, List
+
+from beancount_bot.util import logger
+
+
+class OrderedWorkerPool:
+    """
+    按键分片的工作线程池。同一键（如用户）的任务按提交顺序依次执行，不同分片的任务并行执行
+    """
+
+    def __init__(self, num_threads: int = 8, queue_size: int = 0, name: str = 'worker'):
+        """
+        :param num_threads: 线程数，即分片数
+        :param queue_size: 每个分片的队列长度。队列满时 submit 将阻塞，为 0 则不限制
+        :param name: 线程名前缀
+        """
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=queue_size) for __ in range(num_threads)]
+        self._threads = [threading.Thread(target=self._run, args=(q,), name=f'{name}-{i}', daemon=True)
+                         for i, q in enumerate(self._queues)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key: Hashable, fn: Callable, *args, **kwargs) -> Future:
+        """
+        提交任务
+        :param key: 分片键。键相同的任务不会并行执行，且按提交顺序执行
+        :param fn:
+        :return: 任务完成后完成的 Future
+        """
+        future = Future()
+        self._queues[hash(key) % len(self._queues)].put((future, fn, args, kwargs))
+        return future
+
+    def _run(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                logger.error('任务执行失败', exc_info=e)
+                future.set_exception(e)
+
+    def shutdown(self, wait: bool = True):
+        """
+        执行完已提交的任务后停止所有线程
+        :param wait: 是否等待线程结束
+        :return:
+        """
+        for q in self._queues:
+            q.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
@@ -0,0 +1,58 @@
+"""
+批量模式性能测试：比较逐条消息与单条批量消息的吞吐量
+运行：python -m benchmark.bench_batch
+"""
+import os
+import tempfile
+import time
+
+from beancount_bot.builtin.template_dispatcher import TemplateDispatcher
+from beancount_bot.dispatcher import Dispatcher
+from beancount_bot.transaction import TransactionManager, split_blocks
+
+TEMPLATE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                               'test', 'builtin', 'template_config.yml')
+TOTAL = 2000
+BATCH_SIZES = [1, 10, 50, 200]
+
+# 模板语句与原始 beancount 语句交替
+LINES = [
+    '饭 23 KFC',
+    '2022-01-01 * "Shop" "杂项"\n  Assets:Digital:Alipay\n  Expenses:Misc  12.5 CNY',
+    '饮料 15 "星巴克 咖啡" < wx',
+]
+
+
+class RawDispatcher(Dispatcher):
+    """
+    原样接受 beancount 语法
+    """
+
+    def _process_raw(self, input_str: str) -> str:
+        return input_str
+
+
+def run_case(batch_size, fsync) -> float:
+    messages = ['\n'.join(LINES[i % len(LINES)] for i in range(start, start + batch_size))
+                for start in range(0, TOTAL, batch_size)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manager = TransactionManager([TemplateDispatcher(TEMPLATE_CONFIG), RawDispatcher()],
+                                     os.path.join(tmp_dir, 'bench.bean'), fsync=fsync)
+        begin = time.perf_counter()
+        for message in messages:
+            blocks = split_blocks(message)
+            if len(blocks) > 1:
+                manager.create_batch(blocks)
+            else:
+                manager.create_from_str(message)
+        return TOTAL / (time.perf_counter() - begin)
+
+
+def main():
+    for fsync in ['none', 'entry']:
+        for batch_size in BATCH_SIZES:
+            print(f'fsync={fsync:<6} 每条消息 {batch_size:>3} 条语句  {run_case(batch_size, fsync):>10.0f} 条/秒')
+
+
+if __name__ == '__main__':
+    main()
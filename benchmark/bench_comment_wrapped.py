@@ -0,0 +1,79 @@
+"""
+注释包裹语句删除性能测试：比较逐行读取与内存映射单次扫描的耗时与内存峰值
+运行：python -m benchmark.bench_comment_wrapped [条数 ...]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from beancount_bot.transaction import TransactionManager
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+
+def remove_by_lines(bean_file: str, tx_uuid: str) -> str:
+    """
+    原实现：读取所有行后两次线性查找
+    """
+    with open(bean_file, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    min_line = -1
+    for i in range(len(lines)):
+        if f'TGBOT_START {tx_uuid}' in lines[i]:
+            min_line = i
+            break
+    max_line = -1
+    for i in range(len(lines)):
+        if f'TGBOT_END {tx_uuid}' in lines[i]:
+            max_line = i
+            break
+    with open(bean_file, 'w', encoding='utf-8') as f:
+        f.write(''.join(lines[:min_line] + lines[max_line + 1:]))
+    return ''.join(lines[min_line + 1:max_line])[:-1]
+
+
+def make_ledger(bean_file: str, size: int) -> str:
+    """
+    生成包含 size 条注释包裹语句的账本，返回位于中间的语句 uuid
+    """
+    target = None
+    with open(bean_file, 'w', encoding='utf-8') as f:
+        for i in range(size):
+            tx_uuid = str(uuid.uuid4())
+            if i == size // 2:
+                target = tx_uuid
+            f.write(f'; TGBOT_START {tx_uuid}\n2022-01-01 event "Location" "Home"\n; TGBOT_END {tx_uuid}\n')
+    return target
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    begin = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - begin
+    __, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bean_file = os.path.join(tmp_dir, 'bench.bean')
+        manager = TransactionManager([], bean_file)
+        for size in sizes:
+            target = make_ledger(bean_file, size)
+            mb = os.path.getsize(bean_file) / 1024 / 1024
+            old_time, old_peak = measure(remove_by_lines, bean_file, target)
+            target = make_ledger(bean_file, size)
+            new_time, new_peak = measure(manager._remove_comment_wrapped, bean_file, target)
+            print(f'{size:>9} 条 ({mb:.1f} MiB)  '
+                  f'逐行: {old_time * 1000:9.1f} ms, {old_peak / 1024 / 1024:8.1f} MiB  '
+                  f'mmap: {new_time * 1000:9.1f} ms, {new_peak / 1024 / 1024:8.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
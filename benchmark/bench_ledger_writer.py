@@ -0,0 +1,50 @@
+"""
+账本写入性能测试：比较直接写入与写入线程合并写入的吞吐量
+运行：python -m benchmark.bench_ledger_writer
+"""
+import os
+import tempfile
+import threading
+import time
+
+from beancount_bot.dispatcher import Dispatcher
+from beancount_bot.transaction import TransactionManager
+
+THREADS = 8
+ENTRIES_PER_THREAD = 500
+
+CASES = [
+    ('直接写入, fsync=none', {'fsync': 'none'}),
+    ('直接写入, fsync=entry', {'fsync': 'entry'}),
+    ('写入线程, fsync=none', {'fsync': 'none', 'writer': {}}),
+    ('写入线程, fsync=batch', {'fsync': 'batch', 'writer': {}}),
+    ('写入线程, fsync=entry', {'fsync': 'entry', 'writer': {}}),
+]
+
+
+def run_case(tx, kwargs) -> float:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manager = TransactionManager([], os.path.join(tmp_dir, 'bench.bean'), **kwargs)
+
+        def worker():
+            for __ in range(ENTRIES_PER_THREAD):
+                manager.create(tx)
+
+        threads = [threading.Thread(target=worker) for __ in range(THREADS)]
+        begin = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return THREADS * ENTRIES_PER_THREAD / (time.perf_counter() - begin)
+
+
+def main():
+    tx = Dispatcher().process('')
+    print(f'{THREADS} 线程 x {ENTRIES_PER_THREAD} 条')
+    for name, kwargs in CASES:
+        print(f'{name:<24}{run_case(tx, kwargs):>10.0f} 条/秒')
+
+
+if __name__ == '__main__':
+    main()
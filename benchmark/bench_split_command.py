@@ -0,0 +1,65 @@
+"""
+split_command 性能测试：比较逐字符状态机与正则实现
+运行：python -m benchmark.bench_split_command
+"""
+import timeit
+
+from beancount_bot.builtin.template_dispatcher import split_command
+
+_CH_CLASS = [' ', '\"', '\\', '<']
+_STATE_MAT = [
+    # 空, ", \, <, 其他字符
+    [0, 2, -1, 4, 1],  # 0: 空格
+    [0, 2, -1, 4, 1],  # 1: 词
+    [2, 0, 3, 2, 2],  # 2: 字符串
+    [2, 2, 2, 2, 2],  # 3: 转义
+    [0, 2, -1, -1, 1],  # 4: 符号
+]
+
+
+def split_command_fsm(cmd):
+    """
+    原实现：逐字符状态机
+    """
+    state = 0
+    words = []
+    for i in range(len(cmd)):
+        ch = cmd[i]
+        if ch in _CH_CLASS:
+            ch_class = _CH_CLASS.index(ch)
+        else:
+            ch_class = 4
+        state, old_state = _STATE_MAT[state][ch_class], state
+        if state == -1:
+            raise ValueError(i)
+        if state != old_state and old_state != 3:
+            if state in [1, 2, 4]:
+                words.append('')
+            if state in [2, 3]:
+                continue
+        if state != 0:
+            words[-1] += ch
+    if state not in [0, 1, 4]:
+        raise ValueError(len(cmd))
+    return words
+
+
+CASES = [
+    ('短指令', '饭 23 KFC < wx'),
+    ('带引号参数', '饮料 "10\\"1  <" "星巴克 咖啡" < zfb'),
+    ('长引号参数', '备注 "' + '很长的备注\\"' * 2000 + '"'),
+]
+
+
+def main():
+    for name, cmd in CASES:
+        assert split_command(cmd) == split_command_fsm(cmd)
+        number = max(1, 20000 // len(cmd))
+        old = timeit.timeit(lambda: split_command_fsm(cmd), number=number) / number
+        new = timeit.timeit(lambda: split_command(cmd), number=number) / number
+        print(f'{name:<8}({len(cmd):>6} 字符)  状态机: {old * 1e6:10.1f} us  正则: {new * 1e6:10.1f} us  '
+              f'加速: {old / new:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+模板处理器性能测试：比较直接构建交易与生成语法后解析
+运行：python -m benchmark.bench_template_process
+"""
+import os.path
+import timeit
+
+from beancount.parser import printer
+
+from beancount_bot.builtin.template_dispatcher import TemplateDispatcher
+
+TEMPLATE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                               'test', 'builtin', 'template_config.yml')
+
+CASES = [
+    ('固定模板', 'vultr'),
+    ('参数模板', '饮料 15 "星巴克 咖啡" < wx'),
+    ('计算参数', '饭 23 KFC'),
+]
+
+
+def main():
+    structured = TemplateDispatcher(TEMPLATE_CONFIG)
+    parsed = TemplateDispatcher(TEMPLATE_CONFIG, structured=False)
+    number = 2000
+    for name, cmd in CASES:
+        assert printer.format_entry(structured.process(cmd)) == printer.format_entry(parsed.process(cmd))
+        old = timeit.timeit(lambda: parsed.process(cmd), number=number) / number
+        new = timeit.timeit(lambda: structured.process(cmd), number=number) / number
+        print(f'{name:<6} 解析: {old * 1e6:8.1f} us  直接构建: {new * 1e6:8.1f} us  加速: {old / new:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,54 @@
 import datetime
 import os.path
+import random
 import unittest
+from unittest import mock
+
+from beancount.parser import parser, printer
 
 from beancount_bot import transaction
-from beancount_bot.builtin.template_dispatcher import TemplateDispatcher, split_command
-from beancount_bot.transaction import NotMatchException
+from beancount_bot.builtin import template_dispatcher
+from beancount_bot.builtin.template_dispatcher import TemplateDispatcher, CompiledTemplate, TransactionBuilder, \
+    split_command
+from beancount_bot.dispatcher import ParseContext
+from beancount_bot.transaction import NotMatchException, TransactionManager
 
 PATH = os.path.split(os.path.realpath(__file__))[0]
 
+_CH_CLASS = [' ', '\"', '\\', '<']
+_STATE_MAT = [
+    # 空, ", \, <, 其他字符
+    [0, 2, -1, 4, 1],  # 0: 空格
+    [0, 2, -1, 4, 1],  # 1: 词
+    [2, 0, 3, 2, 2],  # 2: 字符串
+    [2, 2, 2, 2, 2],  # 3: 转义
+    [0, 2, -1, -1, 1],  # 4: 符号
+]
+
+
+def reference_split_command(cmd):
+    """
+    基于状态机的 split_command 参考实现
+    """
+    state = 0
+    words = []
+    for i in range(len(cmd)):
+        ch = cmd[i]
+        ch_class = _CH_CLASS.index(ch) if ch in _CH_CLASS else 4
+        state, old_state = _STATE_MAT[state][ch_class], state
+        if state == -1:
+            raise ValueError(f"位置 {i}：语法错误！不应出现符号 {ch}。")
+        if state != old_state and old_state != 3:
+            if state in [1, 2, 4]:
+                words.append('')
+            if state in [2, 3]:
+                continue
+        if state != 0:
+            words[-1] += ch
+    if state not in [0, 1, 4]:
+        raise ValueError(f"位置 {len(cmd)}：语法错误！字符串、转义未结束。")
+    return words
+
 
 class TestTemplateDispatcher(unittest.TestCase):
 
@@ -18,6 +59,9 @@ class TestTemplateDispatcher(unittest.TestCase):
         self.assertFalse(d.quick_check('咖'))
         self.assertTrue(d.quick_check('饭     4.00'))
         self.assertTrue(d.quick_check('咖啡 123'))
+        self.assertFalse(d.quick_check(''))
+        self.assertFalse(d.quick_check('20 饮料'))
+        self.assertIs(d.commands['饮'], d.commands['咖啡'])
 
     def test_split_command(self):
         cases = [
@@ -54,6 +98,20 @@ class TestTemplateDispatcher(unittest.TestCase):
             except ValueError as e:
                 self.assertIn(str(pos), e.args[0])
 
+    def test_split_command_equivalence(self):
+        rnd = random.Random(20220721)
+        alphabet = [' ', ' ', '"', '"', '\\', '<', 'a', '1', '饭', '\t', '\n']
+        for _ in range(5000):
+            cmd = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 16)))
+            try:
+                expected = reference_split_command(cmd)
+            except ValueError as e:
+                with self.assertRaises(ValueError) as cm:
+                    split_command(cmd)
+                self.assertEqual(e.args[0], cm.exception.args[0], cmd)
+                continue
+            self.assertEqual(expected, split_command(cmd), cmd)
+
     def test_process_simple(self):
         today = datetime.date.today().isoformat()
         cases = [
@@ -129,3 +187,81 @@ class TestTemplateDispatcher(unittest.TestCase):
         self.assertIn(expense, ret)
         self.assertIn('"KFC" "饭"', ret)
         print(ret)
+
+    def test_split_once(self):
+        d1 = TemplateDispatcher(os.path.join(PATH, 'template_config.yml'))
+        d2 = TemplateDispatcher(os.path.join(PATH, 'template_config.yml'))
+        manager = TransactionManager([d1, d2], os.devnull)
+        with mock.patch.object(template_dispatcher, 'split_command', wraps=split_command) as mock_split:
+            # 多个处理器共享同一次切分结果
+            manager._parse_transaction('饮料 20')
+            self.assertEqual(1, mock_split.call_count)
+            self.assertRaises(ValueError, manager._parse_transaction, '123"2')
+            self.assertEqual(2, mock_split.call_count)
+
+    def test_compiled_template(self):
+        compiled = CompiledTemplate({
+            'command': 'test',
+            'computed': {'total': 'int(price) * 2'},
+            'template': '{date} "{{command}}" {unknown} {total}',
+        })
+        arg_map = {'date': '2022-01-01', 'command': '{total}', 'price': '3'}
+        for k, code in compiled.computed:
+            arg_map[k] = eval(code, None, arg_map)
+        # 未知变量原样保留，替换结果不会被再次替换
+        self.assertEqual('2022-01-01 "{{total}}" {unknown} 6', compiled.render(arg_map))
+
+    def test_transaction_builder(self):
+        # 不支持的模板结构
+        self.assertIsNone(TransactionBuilder.compile('{date} * "a" #tag\n  {account}\n'))
+        self.assertIsNone(TransactionBuilder.compile('{date} * "a"\n  {account}\n  key: "value"\n'))
+        self.assertIsNone(TransactionBuilder.compile('{date} * "a"\n  {account}  1 CNY @ 1 USD\n'))
+        template = '\n' \
+                   '    {date} * "{payee}" "{narration}"\n' \
+                   '      {account}\n' \
+                   '      {expense}  {price} {currency}\n'
+        builder = TransactionBuilder.compile(template)
+        parts = template_dispatcher._RE_PLACEHOLDER.split(template)
+        values = {
+            'date': ['2022-01-01', '2022-02-30', '2022/01/01', '22-01-01'],
+            'payee': ['', 'KFC', '星巴克 咖啡', 'a"b', 'a\\b'],
+            'narration': ['饭', ''],
+            'account': ['Assets:Digital:Alipay', 'Assets:支付宝', 'Foo:Bar', 'Assets:x', 'Assets'],
+            'expense': ['Expenses:Food:Dinner:Lunch', 'Expenses:A-1:B'],
+            'price': ['23', '-3.50', '007', '-0', '1,000.5', '1.', '.5', '+3', '1e3', 'abc'],
+            'currency': ['CNY', 'US.D', 'A', 'usd', 'CNY1'],
+        }
+        rnd = random.Random(0)
+        built = 0
+        for __ in range(2000):
+            arg_map = {k: rnd.choice(v) for k, v in values.items()}
+            tx = builder.build(arg_map)
+            if tx is None:
+                continue
+            built += 1
+            # 直接构建的结果与解析结果完全一致
+            entries, errors, __ = parser.parse_string(template_dispatcher._render_parts(parts, arg_map), dedent=True)
+            self.assertEqual([], errors, arg_map)
+            self.assertEqual(entries, [tx], arg_map)
+            self.assertEqual(printer.format_entry(entries[0]), printer.format_entry(tx))
+        self.assertGreater(built, 0)
+
+    def test_process_structured(self):
+        d = TemplateDispatcher(os.path.join(PATH, 'template_config.yml'))
+        self.assertIsNotNone(d.commands['饭'].builder)
+        with mock.patch.object(d, '_parse_raw', wraps=d._parse_raw) as parse_raw:
+            tx = d.process('饭 23 KFC < wx')
+            self.assertEqual([], parse_raw.call_args_list)
+            # 无法直接构建时由解析器校验
+            with self.assertRaises(ValueError):
+                d.process('饭 abc')
+            parse_raw.assert_called_once()
+        self.assertEqual(tx, d._parse_raw(d._process_raw('饭 23 KFC < wx')))
+        # 批量模式下无法直接构建时返回未解析的语法
+        self.assertEqual(tx, d.process_raw_ctx(ParseContext('饭 23 KFC < wx')))
+        self.assertIsInstance(d.process_raw_ctx(ParseContext('饭 abc')), str)
+        # 关闭直接构建
+        d = TemplateDispatcher(os.path.join(PATH, 'template_config.yml'), structured=False)
+        with mock.patch.object(d, '_parse_raw', wraps=d._parse_raw) as parse_raw:
+            d.process('饭 23 KFC < wx')
+            parse_raw.assert_called_once()
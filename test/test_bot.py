@@ -0,0 +1,80 @@
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from telebot import util
+
+from beancount_bot import bot as bot_module
+from beancount_bot.bot import bot, batch_reply, transaction_batch_handler, MAX_BATCH_SIZE
+from beancount_bot.worker_pool import OrderedWorkerPool
+
+
+def make_update(uid: int):
+    return SimpleNamespace(from_user=SimpleNamespace(id=uid))
+
+
+class TestBot(unittest.TestCase):
+
+    def test_session_context(self):
+        barrier = threading.Barrier(2)
+        seen = {}
+
+        def handler(update):
+            # 两个线程同时处于处理器中
+            barrier.wait(5)
+            seen[update.from_user.id] = bot.session_user_id
+
+        threads = [threading.Thread(target=bot.run_handler, args=(handler, make_update(uid))) for uid in (1, 2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual({1: 1, 2: 2}, seen)
+
+    def test_session_context_reset(self):
+        seen = []
+
+        def handler(__):
+            seen.append((bot.session_user_id, bot.session))
+
+        bot.run_handler(handler, make_update(1))
+        # 没有发送者的更新不沿用上一更新的会话
+        bot.run_handler(handler, SimpleNamespace())
+        self.assertEqual(1, seen[0][0])
+        self.assertIsNotNone(seen[0][1])
+        self.assertEqual((None, None), seen[1])
+
+    def test_ordered_exec_task(self):
+        handled = []
+        pool = OrderedWorkerPool(4)
+        bot.ordered_pool = pool
+        try:
+            for i in range(100):
+                bot._exec_task(lambda update, i=i: handled.append((update.from_user.id, bot.session_user_id, i)),
+                               make_update(i % 3))
+        finally:
+            bot.ordered_pool = None
+            pool.shutdown()
+        # 同一用户的更新按顺序处理，且会话上下文对应该用户
+        for uid in range(3):
+            self.assertEqual(list(range(uid, 100, 3)), [i for u, __, i in handled if u == uid])
+        self.assertTrue(all(u == context for u, context, __ in handled))
+
+    def test_batch_limit(self):
+        with mock.patch.object(bot_module, 'get_manager') as get_manager, \
+                mock.patch.object(bot, 'reply_to') as reply_to:
+            transaction_batch_handler(make_update(1), ['a'] * (MAX_BATCH_SIZE + 1), [])
+        # 超出上限时不写入
+        get_manager.assert_not_called()
+        self.assertIn(str(MAX_BATCH_SIZE), reply_to.call_args[0][1])
+
+    def test_batch_reply(self):
+        self.assertEqual('1. a\n  b\n2. c', batch_reply(['a\n  b\n', 'c']))
+        # 超出长度限制时只保留首行
+        texts = ['a\n' + 'b' * 100] * MAX_BATCH_SIZE
+        self.assertEqual('\n'.join(f'{i}. a' for i in range(1, MAX_BATCH_SIZE + 1)), batch_reply(texts))
+        # 首行仍超出则截断
+        reply = batch_reply(['a' * 1000] * MAX_BATCH_SIZE)
+        self.assertLessEqual(len(reply), util.MAX_MESSAGE_LENGTH)
+        self.assertEqual(MAX_BATCH_SIZE, len(reply.split('\n')))
@@ -0,0 +1,69 @@
+import threading
+import time
+import unittest
+
+from telebot.apihelper import ApiTelegramException
+
+from beancount_bot import metrics
+from beancount_bot.broadcast import Broadcaster, TokenBucket
+
+
+class MockBot:
+    def __init__(self, fail_uid: int = None, limit_times: int = 0, retry_after: float = 0.2):
+        self.sent = []
+        self.fail_uid = fail_uid
+        self.limit_times = limit_times
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+
+    def send_message(self, uid, text):
+        with self._lock:
+            if self.limit_times > 0:
+                self.limit_times -= 1
+                raise ApiTelegramException('sendMessage', None, {
+                    'error_code': 429,
+                    'description': 'Too Many Requests',
+                    'parameters': {'retry_after': self.retry_after},
+                })
+            if uid == self.fail_uid:
+                raise ApiTelegramException('sendMessage', None, {
+                    'error_code': 403,
+                    'description': 'Forbidden: bot was blocked by the user',
+                })
+            self.sent.append((time.monotonic(), uid, text))
+
+
+class TestBroadcast(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=50, capacity=5)
+        begin = time.monotonic()
+        for __ in range(30):
+            bucket.acquire()
+        # 突发 5 个，其余 25 个以 50/s 发放
+        self.assertGreaterEqual(time.monotonic() - begin, 0.45)
+
+    def test_broadcast(self):
+        bot = MockBot(fail_uid=3)
+        broadcaster = Broadcaster(bot, workers=4, rate=1000)
+        future = broadcaster.broadcast(range(10), 'hello')
+        report = future.result(5)
+        broadcaster.shutdown()
+        self.assertEqual((10, 9, 1, 0), report[:4])
+        self.assertEqual(sorted(set(range(10)) - {3}), sorted(uid for __, uid, __ in bot.sent))
+        self.assertEqual(report.seconds, metrics.get_metric(metrics.BROADCAST_SECONDS))
+
+    def test_retry_after(self):
+        bot = MockBot(limit_times=1, retry_after=0.3)
+        broadcaster = Broadcaster(bot, workers=2, rate=1000)
+        report = broadcaster.broadcast([1, 2, 3], 'hello').result(5)
+        broadcaster.shutdown()
+        self.assertEqual(3, report.sent)
+        self.assertEqual(1, report.retries)
+        # 被限流的消息等待 retry_after 后重发
+        self.assertGreaterEqual(report.seconds, 0.3)
+
+    def test_empty(self):
+        broadcaster = Broadcaster(MockBot())
+        self.assertEqual(0, broadcaster.broadcast([], 'hello').result(1).total)
+        broadcaster.shutdown()
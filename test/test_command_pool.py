@@ -0,0 +1,70 @@
+import sys
+import time
+import unittest
+
+from beancount_bot.command_pool import CommandPool
+
+PYTHON = f'"{sys.executable}" -c'
+
+
+class TestCommandPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = CommandPool(max_processes=2, output_lines=2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_run(self):
+        results = self.pool.run([
+            f'{PYTHON} "print(1); print(2); print(3)"',
+            f'{PYTHON} "import sys; sys.exit(3)"',
+        ]).result(10)
+        self.assertTrue(results[0].ok)
+        # 只保留末尾输出
+        self.assertEqual('2\n3', results[0].output)
+        self.assertFalse(results[1].ok)
+        self.assertEqual(3, results[1].returncode)
+        self.assertIn('3', results[1].summary())
+
+    def test_undecodable_output(self):
+        result, = self.pool.run([f'{PYTHON} "import sys; sys.stdout.buffer.write(bytes([97, 255, 10]))"']).result(10)
+        # 无法解码的字节被替换，不影响执行
+        self.assertTrue(result.ok)
+        self.assertEqual('a\ufffd', result.output)
+
+    def test_timeout(self):
+        begin = time.perf_counter()
+        result, = self.pool.run([f'{PYTHON} "import time; time.sleep(10)"'], timeout=0.5).result(5)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.ok)
+        self.assertLess(time.perf_counter() - begin, 5)
+
+    def test_timeout_grandchild(self):
+        # 后台子进程继承输出管道，超时后需一并终止，否则读取输出将一直阻塞
+        script = ('import subprocess, sys, time; '
+                  'subprocess.Popen([sys.executable, \'-c\', \'import time; time.sleep(30)\']); '
+                  'time.sleep(30)')
+        begin = time.perf_counter()
+        result, = self.pool.run([f'{PYTHON} "{script}"'], timeout=0.5).result(10)
+        self.assertTrue(result.timed_out)
+        self.assertLess(time.perf_counter() - begin, 5)
+
+    def test_summary_name(self):
+        result, = self.pool.run([f'{PYTHON} "pass"']).result(10)
+        self.assertIn('pass', result.summary())
+        self.assertNotIn('pass', result.summary('#1'))
+
+    def test_parallel(self):
+        commands = [f'{PYTHON} "import time; time.sleep(0.5)"'] * 2
+        begin = time.perf_counter()
+        future = self.pool.run(commands, parallel=True)
+        # 立即返回，不等待指令执行
+        self.assertFalse(future.done())
+        results = future.result(10)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertLess(time.perf_counter() - begin, 0.95)
+
+        begin = time.perf_counter()
+        self.pool.run(commands).result(10)
+        self.assertGreaterEqual(time.perf_counter() - begin, 1.0)
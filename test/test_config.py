@@ -0,0 +1,56 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from beancount_bot import config
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False, encoding='utf-8') as f:
+            f.write('bot:\n  token: test\n')
+            self.config_file = f.name
+        config.load_config(self.config_file)
+
+    def tearDown(self):
+        os.remove(self.config_file)
+
+    def test_get_global_once(self):
+        created = []
+
+        def producer():
+            time.sleep(0.05)
+            created.append(object())
+            return created[-1]
+
+        barrier = threading.Barrier(4)
+        results = []
+
+        def get():
+            barrier.wait(5)
+            results.append(config.get_global('test', producer))
+
+        threads = [threading.Thread(target=get) for __ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 同时获取只创建一次
+        self.assertEqual(1, len(created))
+        self.assertTrue(all(obj is created[0] for obj in results))
+
+    def test_reload_closes_objects(self):
+        closed = []
+
+        class Closable:
+            def close(self):
+                closed.append(self)
+
+        obj = config.get_global('test', Closable)
+        config.load_config(self.config_file)
+        self.assertEqual([obj], closed)
+        self.assertEqual('test', config.get_config('bot.token'))
+        self.assertIsNot(obj, config.get_global('test', Closable))
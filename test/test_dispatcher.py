@@ -1,7 +1,7 @@
 import unittest
 
 from beancount_bot import transaction
-from beancount_bot.dispatcher import Dispatcher
+from beancount_bot.dispatcher import Dispatcher, DispatcherRouter, ParseContext
 
 
 class TestDispatcher(unittest.TestCase):
@@ -32,3 +32,36 @@ class TestDispatcher(unittest.TestCase):
         dispatcher = MockDispatcher()
         with self.assertRaises(ValueError):
             dispatcher.process('')
+
+    def test_process_raw_ctx_overridden(self):
+        class MockDispatcher(Dispatcher):
+            def process(self, input_str: str):
+                return f'; {input_str}'
+
+        # 重载了 process 的处理器在批量模式下不会返回基类的占位交易
+        self.assertEqual('; a', MockDispatcher().process_raw_ctx(ParseContext('a')))
+        self.assertIn('Payee', Dispatcher().process_raw_ctx(ParseContext('a')))
+
+    def test_router(self):
+        class KeywordDispatcher(Dispatcher):
+            def __init__(self, *keywords):
+                super().__init__()
+                self._keywords = keywords
+
+            def keywords(self):
+                return self._keywords
+
+        class StrictDispatcher(KeywordDispatcher):
+            def route_key(self, ctx):
+                if ctx.input_str.startswith('!'):
+                    raise ValueError()
+                return ctx.input_str[:1]
+
+        d_a, d_any, d_ab, d_x = KeywordDispatcher('a'), Dispatcher(), KeywordDispatcher('a', 'b'), StrictDispatcher('x')
+        router = DispatcherRouter([d_a, d_any, d_ab, d_x])
+        self.assertEqual([d_a, d_any, d_ab], router.candidates(ParseContext('a 1')))
+        self.assertEqual([d_any, d_ab], router.candidates(ParseContext('b 1')))
+        self.assertEqual([d_any, d_x], router.candidates(ParseContext('x1')))
+        self.assertEqual([d_any], router.candidates(ParseContext('')))
+        # 无法计算关键词时尝试所有处理器
+        self.assertEqual([d_a, d_any, d_ab, d_x], router.candidates(ParseContext('!')))
@@ -0,0 +1,168 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from beancount_bot import metrics, session
+from beancount_bot.config import set_global, GLOBAL_CONFIG
+from beancount_bot.session_store import SqliteSessionStore, JsonSessionStore
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.session_file = os.path.join(self.tmp_dir.name, 'bot.session')
+
+    def tearDown(self):
+        session.flush_session()
+        if session._store is not None:
+            session._store.close()
+            session._store = None
+        session._session_cache = {}
+        session._retry_delay = 0
+        self.tmp_dir.cleanup()
+
+    def use_config(self, **bot_config):
+        set_global(GLOBAL_CONFIG, {'bot': {'session_file': self.session_file, **bot_config}})
+        session.load_session()
+
+    def test_sqlite_store(self):
+        db_file = self.session_file + '.db'
+        store = SqliteSessionStore(db_file)
+        sessions = {'1': {'auth': True, 'tx_tags': ['a', 'b']}, '2': {'auth': False}}
+        store.save(sessions, [('1', 'auth'), ('1', 'tx_tags'), ('2', 'auth')])
+        # 只写入变化的值
+        del sessions['1']['tx_tags']
+        sessions['2']['auth'] = True
+        store.save(sessions, [('1', 'tx_tags')])
+        store.close()
+        store = SqliteSessionStore(db_file)
+        self.assertEqual({'1': {'auth': True}, '2': {'auth': False}}, store.load())
+        store.close()
+
+    def test_migrate_from_json(self):
+        sessions = {'1': {'auth': True, 'tx_tags': ['a']}}
+        with open(self.session_file, 'w', encoding='utf-8') as f:
+            json.dump(sessions, f)
+        self.use_config()
+        self.assertEqual(['a'], session.get_session(1, session.SESS_TX_TAGS))
+        session.set_session(1, session.SESS_TX_TAGS, ['b'])
+        # 已迁移的数据库不再从 JSON 迁移
+        self.use_config()
+        self.assertEqual(['b'], session.get_session(1, session.SESS_TX_TAGS))
+        self.assertTrue(session.get_session_for(1)[session.SESS_AUTH])
+        self.assertEqual(sessions, JsonSessionStore(self.session_file).load())
+
+    def test_json_backend(self):
+        self.use_config(session_backend='json')
+        session.set_session(1, session.SESS_AUTH, True)
+        session.flush_session()
+        self.assertEqual({'1': {'auth': True}}, JsonSessionStore(self.session_file).load())
+        self.assertFalse(os.path.exists(self.session_file + '.db'))
+        self.assertFalse(os.path.exists(self.session_file + '.tmp'))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            self.use_config(session_backend='unknown')
+
+    def test_transient_session(self):
+        self.use_config(transient_session={'max_size': 2, 'ttl': 3600})
+        # 未鉴权用户不会保存
+        for uid in range(10):
+            session.get_session_for(uid)
+            session.set_session(uid, session.SESS_TX_TAGS, ['spam'])
+        session.flush_session()
+        self.assertEqual({}, session._get_store().load())
+        self.assertEqual([8, 9], list(session.all_user(auth=False)))
+        self.assertEqual([], list(session.all_user()))
+        # 鉴权后保留已有会话并持久化，原视图保持有效
+        view = session.get_session_for(9)
+        session.set_session(9, session.SESS_AUTH, True)
+        self.assertTrue(view[session.SESS_AUTH])
+        session.flush_session()
+        self.assertEqual({'9': {'auth': True, 'tx_tags': ['spam']}}, session._get_store().load())
+        self.assertEqual([9], list(session.all_user()))
+
+    def test_transient_ttl(self):
+        sessions = session.TransientSessions(max_size=10, ttl=60)
+        with mock.patch('time.monotonic', return_value=0):
+            sessions.get('1')['k'] = 'v'
+            sessions.get('2')
+        with mock.patch('time.monotonic', return_value=30):
+            self.assertEqual({'k': 'v'}, sessions.peek('1'))
+            sessions.get('2')
+        with mock.patch('time.monotonic', return_value=61):
+            self.assertIsNone(sessions.peek('1'))
+            self.assertEqual(['2'], sessions.keys())
+
+    def test_auth_users(self):
+        with open(self.session_file, 'w', encoding='utf-8') as f:
+            json.dump({'1': {'auth': True}, '2': {'auth': False}, '3': {}}, f)
+        self.use_config()
+        self.assertEqual([1], session.all_user())
+        self.assertEqual(1, metrics.get_metric(metrics.AUTH_USERS))
+        session.set_session(2, session.SESS_AUTH, True)
+        session.set_session(4, session.SESS_AUTH, True)
+        session.set_session(1, session.SESS_AUTH, False)
+        self.assertEqual([2, 4], sorted(session.all_user()))
+        self.assertEqual(2, metrics.get_metric(metrics.AUTH_USERS))
+
+    def test_flush_coalesce(self):
+        self.use_config(session_flush_interval=3600)
+        store = session._get_store()
+        with mock.patch.object(store, 'save', wraps=store.save) as save:
+            session.set_session(1, session.SESS_AUTH, True)
+            for i in range(10):
+                session.set_session(1, session.SESS_TX_TAGS, [str(i)])
+            # 变化在后台合并写入
+            self.assertEqual(0, save.call_count)
+            self.assertIsNotNone(session._flush_timer)
+            session.flush_session()
+            self.assertEqual(1, save.call_count)
+            self.assertIsNone(session._flush_timer)
+        self.assertEqual({'1': {'auth': True, 'tx_tags': ['9']}}, store.load())
+
+    def test_flush_interval(self):
+        self.use_config(session_flush_interval=0.05)
+        session.set_session(1, session.SESS_AUTH, True)
+        deadline = time.time() + 5
+        while session._get_store().load() == {} and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({'1': {'auth': True}}, session._get_store().load())
+
+    def test_flush_changed_users_only(self):
+        self.use_config(session_flush_interval=3600)
+        for uid in range(100):
+            session.set_session(uid, session.SESS_AUTH, True)
+        session.flush_session()
+        store = session._get_store()
+        with mock.patch.object(store, 'save', wraps=store.save) as save:
+            session.set_session(7, session.SESS_TX_TAGS, ['a'])
+            session.flush_session()
+            # 增量存储只获得变化用户的会话
+            sessions, changed = save.call_args[0]
+            self.assertEqual(['7'], list(sessions.keys()))
+            self.assertEqual({('7', session.SESS_TX_TAGS)}, set(changed))
+        self.assertEqual(['a'], store.load()['7'][session.SESS_TX_TAGS])
+
+    def test_flush_retry_backoff(self):
+        self.use_config(session_flush_interval=0)
+        store = session._get_store()
+        with mock.patch.object(store, 'save', side_effect=OSError('disk full')) as save:
+            session.set_session(1, session.SESS_AUTH, True)
+            self.assertEqual(1, save.call_count)
+            # 失败后延迟重试，期间的变化不立即写入
+            self.assertEqual(1, session._retry_delay)
+            self.assertEqual(1, session._flush_timer.interval)
+            session.set_session(1, session.SESS_TX_TAGS, ['a'])
+            self.assertEqual(1, save.call_count)
+            # 连续失败时重试间隔指数增长
+            session.flush_session()
+            self.assertEqual(2, session._retry_delay)
+            self.assertEqual(2, session._flush_timer.interval)
+        session.flush_session()
+        self.assertEqual(0, session._retry_delay)
+        self.assertEqual({'1': {'auth': True, 'tx_tags': ['a']}}, store.load())
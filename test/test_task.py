@@ -0,0 +1,232 @@
+import datetime
+import threading
+import unittest
+from concurrent.futures import CancelledError, Future
+from types import SimpleNamespace
+from unittest import mock
+
+import schedule
+
+from beancount_bot import metrics, task
+from beancount_bot.task import ScheduleTask, ScheduleThread, TaskExecutor, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED
+
+
+class TestScheduleThread(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = schedule.Scheduler()
+        self.thread = ScheduleThread(self.scheduler)
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.stop()
+        self.thread.join(5)
+
+    def test_run_on_time(self):
+        fired = threading.Event()
+        job = self.scheduler.every(1).seconds.do(fired.set)
+        self.thread.wakeup()
+        due = job.next_run
+        self.assertTrue(fired.wait(3))
+        fired_at = datetime.datetime.now()
+        # 不再以固定间隔轮询，任务在到期时即执行
+        self.assertLess((fired_at - due).total_seconds(), 0.2)
+        self.assertLess(metrics.get_metric(metrics.SCHEDULE_LATENESS), 0.2)
+
+    def test_wakeup(self):
+        fired = threading.Event()
+        # 线程空闲等待时加入新任务
+        job = self.scheduler.every(10).seconds.do(fired.set)
+        job.next_run = datetime.datetime.now() + datetime.timedelta(milliseconds=100)
+        self.thread.wakeup()
+        self.assertTrue(fired.wait(2))
+
+    def test_clock_jump(self):
+        thread = ScheduleThread(self.scheduler, max_wait=0.1)
+        thread.start()
+        try:
+            fired = threading.Event()
+            self.scheduler.every(10).minutes.do(fired.set)
+            thread.wakeup()
+            self.assertFalse(fired.wait(0.3))
+
+            # 模拟系统时间向前跳变 10 分钟，线程无需唤醒即可在下次重新计算时执行
+            class JumpedDatetime(datetime.datetime):
+                @classmethod
+                def now(cls, tz=None):
+                    return datetime.datetime.now(tz) + datetime.timedelta(minutes=10)
+
+            with mock.patch.object(task, 'datetime', SimpleNamespace(datetime=JumpedDatetime)):
+                self.assertTrue(fired.wait(2))
+        finally:
+            thread.stop()
+            thread.join(5)
+
+    def test_without_wakeup(self):
+        thread = ScheduleThread(self.scheduler, max_wait=0.1)
+        thread.start()
+        try:
+            # 未调用 wakeup 而加入、取消的任务在下次唤醒时生效
+            fired = threading.Event()
+            self.scheduler.every(1).seconds.do(fired.set)
+            self.assertTrue(fired.wait(2))
+            cancelled = threading.Event()
+            job = self.scheduler.every(10).seconds.do(cancelled.set)
+            job.next_run = datetime.datetime.now() + datetime.timedelta(milliseconds=300)
+            threading.Event().wait(0.2)
+            self.scheduler.cancel_job(job)
+            self.assertFalse(cancelled.wait(0.5))
+        finally:
+            thread.stop()
+            thread.join(5)
+
+    def test_start_schedule_thread_interval(self):
+        with mock.patch.object(task, '_schedule_thread', None), \
+                mock.patch.object(ScheduleThread, 'start') as start:
+            with self.assertWarns(DeprecationWarning):
+                thread = task.start_schedule_thread(5)
+            self.assertIsInstance(thread, ScheduleThread)
+            start.assert_called_once()
+
+    def test_cancel(self):
+        fired = threading.Event()
+        job = self.scheduler.every(1).seconds.do(fired.set)
+        self.thread.wakeup()
+        self.scheduler.cancel_job(job)
+        self.thread.wakeup()
+        self.assertFalse(fired.wait(1.5))
+
+    def test_error(self):
+        calls = []
+
+        def fail():
+            calls.append(datetime.datetime.now())
+            raise ValueError()
+
+        job = self.scheduler.every(10).seconds.do(fail)
+        job.next_run = datetime.datetime.now()
+        self.thread.wakeup()
+        threading.Event().wait(0.5)
+        # 出错的任务推迟至下次运行时间，不会反复执行
+        self.assertEqual(1, len(calls))
+        self.assertGreater(job.next_run, datetime.datetime.now())
+
+
+class MockTask(ScheduleTask):
+    def __init__(self, fail: bool = False):
+        super().__init__()
+        self.fail = fail
+        self.release = threading.Event()
+        self.runs = 0
+
+    def trigger(self, bot):
+        self.runs += 1
+        future = Future()
+
+        def run():
+            self.release.wait(5)
+            if self.fail:
+                future.set_exception(ValueError('fail'))
+            else:
+                future.set_result(None)
+
+        threading.Thread(target=run).start()
+        return future
+
+
+class TestTaskExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = TaskExecutor(max_workers=2, history=2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def wait_finished(self, job):
+        for __ in range(100):
+            if job.status in (JOB_SUCCEEDED, JOB_FAILED):
+                return
+            threading.Event().wait(0.05)
+        self.fail('任务未结束')
+
+    def test_dedup(self):
+        task = MockTask()
+        job, created = self.executor.submit('a', task, None)
+        self.assertTrue(created)
+        # 运行期间再次触发，返回正在运行的记录
+        again, created = self.executor.submit('a', task, None)
+        self.assertFalse(created)
+        self.assertIs(job, again)
+        running, finished = self.executor.jobs()
+        self.assertEqual([job], running)
+        self.assertEqual([], finished)
+
+        task.release.set()
+        self.wait_finished(job)
+        self.assertEqual(JOB_SUCCEEDED, job.status)
+        self.assertEqual(1, task.runs)
+        # 结束后可以再次触发
+        job2, created = self.executor.submit('a', task, None)
+        self.assertTrue(created)
+        self.assertGreater(job2.id, job.id)
+        self.wait_finished(job2)
+
+    def test_jobs_consistent(self):
+        task = MockTask()
+        job, __ = self.executor.submit('a', task, None)
+        stop = threading.Event()
+        seen = []
+
+        def poll():
+            while not stop.is_set():
+                running, finished = self.executor.jobs()
+                seen.extend((j.status, j.finished) for j in finished)
+
+        thread = threading.Thread(target=poll)
+        thread.start()
+        task.release.set()
+        self.wait_finished(job)
+        threading.Event().wait(0.05)
+        stop.set()
+        thread.join()
+        # 已完成列表中的记录总有最终状态与结束时间
+        self.assertTrue(len(seen) > 0)
+        self.assertTrue(all(status == JOB_SUCCEEDED and finished is not None for status, finished in seen))
+
+    def test_cancelled(self):
+        future = Future()
+
+        class CancelTask(ScheduleTask):
+            def trigger(self, bot):
+                return future
+
+        job, __ = self.executor.submit('a', CancelTask(), None)
+        for __ in range(100):
+            if job.status == JOB_RUNNING:
+                break
+            threading.Event().wait(0.01)
+        future.cancel()
+        self.wait_finished(job)
+        # 任务返回的 Future 被取消时，任务以失败结束，之后可以再次触发
+        self.assertEqual(JOB_FAILED, job.status)
+        self.assertIsInstance(job.error, CancelledError)
+        self.assertTrue(self.executor.submit('a', CancelTask(), None)[1])
+
+    def test_history(self):
+        done = []
+        jobs = []
+        for name, fail in (('a', False), ('b', True), ('c', False)):
+            task = MockTask(fail)
+            task.release.set()
+            finished = threading.Event()
+            job, __ = self.executor.submit(name, task, None, callback=lambda j: (done.append(j), finished.set()))
+            self.assertTrue(finished.wait(5))
+            jobs.append(job)
+        self.assertEqual(jobs, done)
+        self.assertEqual(JOB_FAILED, jobs[1].status)
+        self.assertIsInstance(jobs[1].error, ValueError)
+        running, finished = self.executor.jobs()
+        self.assertEqual([], running)
+        # 只保留最近的记录，新的在前
+        self.assertEqual([jobs[2], jobs[1]], finished)
+        self.assertGreater(jobs[0].elapsed, 0)
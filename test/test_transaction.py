@@ -1,9 +1,17 @@
+import datetime
+import os
 import tempfile
+import threading
+import time
 import unittest
 import uuid
+from unittest import mock
+
+from beancount.parser import parser, printer
 
 from beancount_bot import transaction
 from beancount_bot.dispatcher import Dispatcher
+from beancount_bot.ledger_index import INDEX_SUFFIX
 from beancount_bot.transaction import TransactionManager
 
 
@@ -37,6 +45,32 @@ class TestTransactionManager(unittest.TestCase):
         self.assertIn('Income:Unknown\n', tx_str)
         self.assertIn('Assets:Unknown  1 CNY\n', tx_str)
 
+    def test_create_text(self):
+        tx = parser.parse_string('2010-01-01 * "Payee" "Desc"\n'
+                                 '  Income:Unknown\n'
+                                 '  Assets:Unknown  1 CNY\n')[0][0]
+        meta = dict(tx.meta)
+        manager = TransactionManager([], self.tmp_file)
+        result = manager.create(tx, add_tags=['tag'])
+        tx_uuid, created = result
+        # 写入账本与返回的为同一文本
+        self.assertEqual(printer.format_entry(created), result.text)
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            self.assertEqual(result.text + '\n', f.read())
+        self.assertIn('#tag', result.text)
+        self.assertEqual(tx_uuid, created.meta[transaction.META_UUID])
+        # 不修改传入的交易
+        self.assertEqual(meta, tx.meta)
+        self.assertIs(tx.postings, created.postings)
+        # 回复文本不含控制元数据
+        self.assertIn(transaction.META_UUID, result.text)
+        self.assertNotIn('tgbot_', result.reply_text)
+        self.assertEqual(result.text.replace(f'  {transaction.META_UUID}: "{tx_uuid}"\n', '')
+                         .replace(f'  {transaction.META_TIME}: "{created.meta[transaction.META_TIME]}"\n', ''),
+                         result.reply_text)
+        raw = manager.create('; comment')
+        self.assertEqual('; comment', raw.reply_text)
+
     def test_create_raw(self):
         # Mock
         class MockDispatcher(Dispatcher):
@@ -50,6 +84,78 @@ class TestTransactionManager(unittest.TestCase):
         with open(self.tmp_file, 'r', encoding='utf-8') as f:
             self.assertIn(tx_uuid, f.read())
 
+    def test_split_blocks(self):
+        text = 'a 1\n\n2022-01-01 * "x"\n  Assets:A  1 CNY\n\tAssets:B\n  \nb 2\n'
+        self.assertEqual(['a 1', '2022-01-01 * "x"\n  Assets:A  1 CNY\n\tAssets:B', 'b 2'],
+                         transaction.split_blocks(text))
+        self.assertEqual([], transaction.split_blocks('\n  \n'))
+
+    def test_create_batch(self):
+        # Mock
+        class MockDispatcher(Dispatcher):
+            def quick_check(self, input_str: str) -> bool:
+                return input_str != 'unknown'
+
+            def _process_raw(self, input_str: str) -> str:
+                if input_str == 'comment':
+                    return '; comment'
+                if input_str == 'twice':
+                    return '2010-01-01 open Assets:A\n2010-01-01 open Assets:B\n'
+                return f'''
+                2010-01-01 * "Payee" "{input_str}"
+                  Income:Unknown
+                  Assets:Unknown  1 CNY
+                '''
+
+        manager = TransactionManager([MockDispatcher()], self.tmp_file)
+        with mock.patch.object(parser, 'parse_string', wraps=parser.parse_string) as parse_string, \
+                mock.patch.object(manager, '_write_entries', wraps=manager._write_entries) as write_entries:
+            results = manager.create_batch(['a', 'comment', 'b'], add_tags=['tag'])
+            # 逐条解析、一次写入
+            self.assertEqual(3, parse_string.call_count)
+            self.assertEqual(1, write_entries.call_count)
+        self.assertEqual(['a', 'b'], [results[0][1].narration, results[2][1].narration])
+        self.assertEqual('; comment', results[1][1])
+        self.assertEqual({'tag'}, results[2][1].tags)
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+        for result in results:
+            self.assertIn(result.text, content)
+        # 单独撤回其中一条
+        manager.remove(results[0][0])
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+        self.assertNotIn(results[0].text, content)
+        self.assertIn(results[2].text, content)
+        # 任一语句有误则不写入
+        size = os.path.getsize(self.tmp_file)
+        for blocks, n in [(['a', 'unknown'], 2), (['twice', 'a'], 1), (['a', 'b', '2010-13-01 * "x"'], 3)]:
+            with self.assertRaises(ValueError) as ctx:
+                manager.create_batch(blocks)
+            self.assertIn(f'第 {n} 条', ctx.exception.args[0])
+        self.assertEqual(size, os.path.getsize(self.tmp_file))
+
+    def test_create_batch_isolated(self):
+        # Mock
+        class MockDispatcher(Dispatcher):
+            def _process_raw(self, input_str: str) -> str:
+                if input_str == 'pushtag':
+                    return 'pushtag #pushed\n'
+                return f'''
+                2010-01-01 * "Payee" "{input_str}"
+                  Income:Unknown
+                  Assets:Unknown  1 CNY
+                '''
+
+        manager = TransactionManager([MockDispatcher()], self.tmp_file)
+        # 各条语句单独解析，pushtag 不会作用于后续语句，而是未配对的错误
+        with self.assertRaises(ValueError) as ctx:
+            manager.create_batch(['a', 'pushtag', 'b'])
+        self.assertIn('第 2 条', ctx.exception.args[0])
+        self.assertEqual(0, os.path.getsize(self.tmp_file))
+        results = manager.create_batch(['a', 'b'])
+        self.assertEqual([set(), set()], [result[1].tags for result in results])
+
     def test_remove(self):
         # Mock
         poison_str = str(uuid.uuid4())
@@ -141,3 +247,239 @@ class TestTransactionManager(unittest.TestCase):
 
         with open(self.tmp_file, 'w', encoding='utf-8') as f:
             f.write(data.replace('wrong syntax', ''))
+
+    def test_remove_with_index(self):
+        # Mock
+        class MockDispatcher(Dispatcher):
+            def _process_raw(self, input_str: str) -> str:
+                if input_str == 'raw':
+                    return '; comment'
+                return f'''
+                2010-01-01 * "Payee" "{input_str}"
+                  Income:Unknown
+                  Assets:Unknown  1 CNY
+                '''
+
+        manager = TransactionManager([MockDispatcher()], self.tmp_file)
+        names = [str(uuid.uuid4()) for _ in range(3)]
+        created = [manager.create_from_str(name)[0] for name in names]
+        raw_uuid, _ = manager.create_from_str('raw')
+        self.assertTrue(os.path.exists(self.tmp_file + INDEX_SUFFIX))
+        # 从中间、末尾、开头依次删除
+        for i in [1, 2, 0]:
+            delete_tx = manager.remove(created[i])
+            self.assertEqual(names[i], delete_tx.narration)
+            with open(self.tmp_file, 'r', encoding='utf-8') as f:
+                self.assertNotIn(names[i], f.read())
+        self.assertEqual('; comment', manager.remove(raw_uuid))
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            self.assertEqual('', f.read().strip())
+
+    def test_remove_after_external_edit(self):
+        # Mock
+        poison_str = str(uuid.uuid4())
+
+        class MockDispatcher(Dispatcher):
+            def _process_raw(self, input_str: str) -> str:
+                return f'''
+                2010-01-01 * "Payee" "{poison_str}"
+                  Income:Unknown
+                  Assets:Unknown  1 CNY
+                '''
+
+        manager = TransactionManager([MockDispatcher()], self.tmp_file)
+        tx_uuid, _ = manager.create_from_str('')
+        # 在索引之外修改账本，使索引中的位置失效
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            data = f.read()
+        with open(self.tmp_file, 'w', encoding='utf-8') as f:
+            f.write('; external edit\n' + data)
+
+        manager = TransactionManager([MockDispatcher()], self.tmp_file)
+        delete_tx = manager.remove(tx_uuid)
+        self.assertEqual(tx_uuid, delete_tx.meta[transaction.META_UUID])
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            data = f.read()
+        self.assertNotIn(poison_str, data)
+        self.assertIn('; external edit', data)
+
+    def test_remove_cross_shard(self):
+        # Mock
+        class MockDispatcher(Dispatcher):
+            def _process_raw(self, input_str: str) -> str:
+                return '''
+                2010-01-01 * "Payee" "Desc"
+                  Income:Unknown
+                  Assets:Unknown  1 CNY
+                '''
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # 在历史分片中创建交易
+            old_shard = os.path.join(tmp_dir, '2000-01.bean')
+            old_uuid, _ = TransactionManager([MockDispatcher()], old_shard).create_from_str('')
+            # 启动时扫描所有分片，可以撤回不在当前分片的交易
+            manager = TransactionManager([MockDispatcher()], os.path.join(tmp_dir, '{year}-{month}.bean'))
+            cur_uuid, _ = manager.create_from_str('')
+            self.assertNotEqual(old_shard, manager.bean_file)
+            self.assertEqual(old_uuid, manager.remove(old_uuid).meta[transaction.META_UUID])
+            self.assertEqual(cur_uuid, manager.remove(cur_uuid).meta[transaction.META_UUID])
+            with open(old_shard, 'r', encoding='utf-8') as f:
+                self.assertNotIn(old_uuid, f.read())
+            self.assertRaises(ValueError, manager.remove, old_uuid)
+
+    def test_shard_files_exclude_aux(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # 账本文件名没有固定后缀时，索引与临时文件同样匹配通配符
+            for name in ('2021', '2022', '2022' + INDEX_SUFFIX, '2022' + INDEX_SUFFIX + '.tmp', '2022.compact'):
+                with open(os.path.join(tmp_dir, name), 'w', encoding='utf-8') as f:
+                    f.write('; comment\n')
+            manager = TransactionManager([], os.path.join(tmp_dir, '{year}'))
+            self.assertEqual(['2021', '2022'], sorted(os.path.basename(path) for path in manager._shard_files()))
+
+    def test_create_with_writer(self):
+        # Mock
+        class MockDispatcher(Dispatcher):
+            def _process_raw(self, input_str: str) -> str:
+                return f'''
+                2010-01-01 * "Payee" "{input_str}"
+                  Income:Unknown
+                  Assets:Unknown  1 CNY
+                '''
+
+        manager = TransactionManager([MockDispatcher()], self.tmp_file, fsync='batch', writer={'max_batch': 8})
+        names = [str(uuid.uuid4()) for _ in range(32)]
+        created = {}
+
+        def worker(name):
+            created[name], _ = manager.create_from_str(name)
+
+        threads = [threading.Thread(target=worker, args=(name,)) for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            data = f.read()
+        for name in names:
+            self.assertIn(name, data)
+        # 不等待写入时，撤回前会等待写入完成
+        tx_uuid, _ = manager.create(MockDispatcher().process('async'), wait=False)
+        self.assertEqual('async', manager.remove(tx_uuid).narration)
+        for name in names:
+            self.assertEqual(name, manager.remove(created[name]).narration)
+
+    def test_bad_fsync(self):
+        self.assertRaises(ValueError, TransactionManager, [], self.tmp_file, fsync='never')
+
+    def test_remove_tombstone(self):
+        # Mock
+        class MockDispatcher(Dispatcher):
+            def _process_raw(self, input_str: str) -> str:
+                return f'''
+                2010-01-01 * "Payee" "{input_str}"
+                  Income:Unknown
+                  Assets:Unknown  1 CNY
+                '''
+
+        manager = TransactionManager([MockDispatcher()], self.tmp_file, withdraw_mode='tombstone',
+                                     compact_interval=3600)
+        names = [str(uuid.uuid4()) for _ in range(3)]
+        created = [manager.create_from_str(name)[0] for name in names]
+        size = os.path.getsize(self.tmp_file)
+        # 撤回不改变账本大小，账本仍然合法
+        self.assertEqual(names[1], manager.remove(created[1]).narration)
+        self.assertEqual(size, os.path.getsize(self.tmp_file))
+        entries, errors, _ = parser.parse_file(self.tmp_file)
+        self.assertEqual(0, len(errors))
+        self.assertEqual([names[0], names[2]], [tx.narration for tx in entries])
+        self.assertRaises(ValueError, manager.remove, created[1])
+        # 压缩后撤回标记被清除
+        manager.compact()
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            data = f.read()
+        self.assertNotIn('TGBOT_DEL', data)
+        self.assertNotIn(names[1], data)
+        self.assertEqual(names[2], manager.remove(created[2]).narration)
+
+    def test_compact_threshold(self):
+        # Mock
+        class MockDispatcher(Dispatcher):
+            def _process_raw(self, input_str: str) -> str:
+                return '; comment'
+
+        manager = TransactionManager([MockDispatcher()], self.tmp_file, withdraw_mode='tombstone',
+                                     compact_interval=3600, compact_threshold=1)
+        tx_uuid, _ = manager.create_from_str('')
+        manager.remove(tx_uuid)
+        # 超过阈值，立即在后台压缩
+        for _ in range(100):
+            if os.path.getsize(self.tmp_file) == 0:
+                break
+            time.sleep(0.05)
+        self.assertEqual(0, os.path.getsize(self.tmp_file))
+
+    def test_replaced_manager(self):
+        # Mock
+        class MockDispatcher(Dispatcher):
+            def _process_raw(self, input_str: str) -> str:
+                return f'; {input_str}'
+
+        # 重载配置前后的两个管理对象操作同一账本
+        old = TransactionManager([MockDispatcher()], self.tmp_file, writer={}, withdraw_mode='tombstone',
+                                 compact_interval=3600, compact_threshold=1)
+        new = TransactionManager([MockDispatcher()], self.tmp_file, writer={})
+        old_uuids = [old.create_from_str(f'old-{i}')[0] for i in range(50)]
+
+        def withdraw():
+            for tx_uuid in old_uuids:
+                old.remove(tx_uuid)
+                old.compact()
+
+        thread = threading.Thread(target=withdraw)
+        thread.start()
+        new_names = [f'new-{i}' for i in range(50)]
+        for name in new_names:
+            new.create_from_str(name)
+        thread.join()
+        old.close()
+        self.assertIsNone(old._compact_timer)
+        # 压缩不会覆盖另一管理对象追加的交易
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            data = f.read()
+        self.assertTrue(all(f'; {name}\n' in data for name in new_names))
+        self.assertNotIn('old-', data)
+        new.close()
+
+    def test_remove_unindexed_comment_wrapped(self):
+        manager = TransactionManager([], self.tmp_file)
+        tx_uuid = str(uuid.uuid4())
+        # 手工写入、索引无法识别的注释包裹语句
+        with open(self.tmp_file, 'a+', encoding='utf-8') as f:
+            f.write(f'; pre\n  ; TGBOT_START {tx_uuid}\n; 注释\n  ; TGBOT_END {tx_uuid}\n; post\n')
+        self.assertEqual('; 注释', manager.remove(tx_uuid))
+        with open(self.tmp_file, 'r', encoding='utf-8') as f:
+            self.assertEqual('; pre\n; post\n', f.read())
+
+    def test_bean_file_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manager = TransactionManager([], os.path.join(tmp_dir, '{year}', '{month}.bean'))
+            bean_file = manager.bean_file
+            self.assertTrue(os.path.isdir(os.path.dirname(bean_file)))
+            # 缓存期间不再创建文件夹
+            os.rmdir(os.path.dirname(bean_file))
+            self.assertEqual(bean_file, manager.bean_file)
+            self.assertFalse(os.path.exists(os.path.dirname(bean_file)))
+
+    def test_next_boundary(self):
+        now = datetime.datetime(2022, 12, 31, 23, 59)
+        cases = [
+            ('{year}-{month}-{date}.bean', datetime.datetime(2023, 1, 1)),
+            ('{year}-{month}.bean', datetime.datetime(2023, 1, 1)),
+            ('{year}.bean', datetime.datetime(2023, 1, 1)),
+        ]
+        for bean_file, expected in cases:
+            self.assertEqual(expected.timestamp(), transaction._next_boundary(bean_file, now))
+        now = datetime.datetime(2022, 7, 21, 11, 32)
+        self.assertEqual(datetime.datetime(2022, 7, 22).timestamp(), transaction._next_boundary('{date}.bean', now))
+        self.assertEqual(datetime.datetime(2022, 8, 1).timestamp(), transaction._next_boundary('{month}.bean', now))
+        self.assertEqual(float('inf'), transaction._next_boundary('main.bean', now))
@@ -0,0 +1,94 @@
+import http.client
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+from beancount_bot.webhook import WebhookServer
+
+
+def make_update(update_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 1640995200,
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+        },
+    }
+
+
+class MockBot:
+    def __init__(self):
+        self.updates = []
+        self.received = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def process_new_updates(self, updates):
+        self.release.wait(5)
+        self.updates.extend(updates)
+        self.received.set()
+
+
+class TestWebhookServer(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = MockBot()
+        self.server = WebhookServer(self.bot, port=0, path='/hook', queue_size=1, max_body_size=4096)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.bot.release.set()
+        self.server.shutdown()
+        self.thread.join()
+
+    def post(self, path: str, body: bytes) -> int:
+        host, port = self.server.server_address
+        request = urllib.request.Request(f'http://{host}:{port}{path}', data=body,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_receive_update(self):
+        self.assertEqual(200, self.post('/hook', json.dumps(make_update(1, '饭 23')).encode('utf-8')))
+        self.assertTrue(self.bot.received.wait(5))
+        self.assertEqual(1, self.bot.updates[0].update_id)
+        self.assertEqual('饭 23', self.bot.updates[0].message.text)
+
+    def test_bad_request(self):
+        self.assertEqual(404, self.post('/other', json.dumps(make_update(1, 'a')).encode('utf-8')))
+        self.assertEqual(400, self.post('/hook', b'not json'))
+        self.assertEqual([], self.bot.updates)
+
+    def test_bad_body(self):
+        host, port = self.server.server_address
+        # 缺少或非法的 Content-Length
+        for length in (None, 'abc', '-1'):
+            conn = http.client.HTTPConnection(host, port, timeout=5)
+            conn.putrequest('POST', '/hook', skip_accept_encoding=True)
+            if length is not None:
+                conn.putheader('Content-Length', length)
+            conn.endheaders()
+            self.assertEqual(400, conn.getresponse().status)
+            conn.close()
+        # 请求体过大
+        self.assertEqual(413, self.post('/hook', b' ' * 5000))
+        self.assertEqual([], self.bot.updates)
+
+    def test_queue_full(self):
+        self.bot.release.clear()
+        statuses = [self.post('/hook', json.dumps(make_update(i, 'a')).encode('utf-8')) for i in range(5)]
+        # 处理中的一条与队列中的一条之外，其余返回 503 由 Telegram 重发
+        self.assertEqual(503, statuses[-1])
+        self.bot.release.set()
+        self.server.shutdown()
+        self.thread.join()
+        self.assertEqual(statuses.count(200), len(self.bot.updates))
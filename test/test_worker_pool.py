@@ -0,0 +1,46 @@
+import threading
+import time
+import unittest
+
+from beancount_bot.worker_pool import OrderedWorkerPool
+
+
+class TestOrderedWorkerPool(unittest.TestCase):
+
+    def test_order_per_key(self):
+        pool = OrderedWorkerPool(4)
+        done = {}
+        futures = []
+        for i in range(200):
+            key = i % 7
+
+            def task(key=key, i=i):
+                # 打乱执行时间，检验同键任务不会乱序
+                time.sleep(0.001 * (i % 3))
+                done.setdefault(key, []).append(i)
+                return i
+
+            futures.append(pool.submit(key, task))
+        self.assertEqual(list(range(200)), [f.result(5) for f in futures])
+        pool.shutdown()
+        for key, items in done.items():
+            self.assertEqual(list(range(key, 200, 7)), items)
+
+    def test_parallel_keys(self):
+        pool = OrderedWorkerPool(2)
+        barrier = threading.Barrier(2)
+        # 不同分片的任务同时执行，否则 barrier 超时
+        keys = [0, 1]
+        futures = [pool.submit(key, barrier.wait, 5) for key in keys]
+        for f in futures:
+            f.result(5)
+        pool.shutdown()
+
+    def test_exception(self):
+        pool = OrderedWorkerPool(1)
+        failed = pool.submit('a', lambda: 1 / 0)
+        ok = pool.submit('a', lambda: 'ok')
+        with self.assertRaises(ZeroDivisionError):
+            failed.result(5)
+        self.assertEqual('ok', ok.result(5))
+        pool.shutdown()